@@ -2,15 +2,28 @@ import sys
 import os
 import re
 import json
-import yaml
-import subprocess
 import argparse
+import itertools
 import locale
 import metatask
-from metatask.process import Process
-from metatask.utils import files, read_metadata, print_diff, confirm
+from metatask.process import Process, get_runner
+from metatask.plan import CommandPlan, precompile_templates
+from metatask.collision import CollisionIndex
+from metatask.jobs import JobList
+from metatask.bulk import BulkRenamer, BULK_SIZE
+from metatask.executor import EXECUTORS, CHUNK_SIZE, executor_type, lock_path, init_worker, run_chunk, \
+    job_failed
+from metatask.utils import files, read_metadata, read_metadata_batch, print_diff, confirm, \
+    ordered_map, chunks, LazyMetadata
+from metatask.exiftool import BATCH_SIZE
+from metatask.cache import commit_cache
+from metatask.state import get_state, commit_state
+from metatask.stats import get_stats
+from metatask.events import report, start_reporter, stop_reporter, get_reporter, open_events, close_events
+from metatask.journal import get_journal, start_journal, close_journal, read_journal, interrupted_journals, \
+    discard_journals, resume_journal, release_resumed
 from bashcolor import colorize, RED, BLUE, GREEN
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, CancelledError, as_completed, wait, FIRST_COMPLETED
 
 
 CONFIG_FILENAME = "metatask.yaml"
@@ -78,6 +91,50 @@ See also: https://docs.python.org/2/library/re.html#module-contents''')
         '--dry-run', action='store_true',
         help='just see the diff'
     )
+    parser.add_argument(
+        '--executor', choices=EXECUTORS, default=None,
+        help='run the jobs in threads or in processes, auto use the processes for the rename only tasks',
+    )
+    parser.add_argument(
+        '--stream', action='store_true',
+        help='with --apply, start to process the files while the directories are walked',
+    )
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='skip the files already processed by the same commands, and with unchanged output',
+    )
+    parser.add_argument(
+        '--force', action='store_true',
+        help='with --incremental, process all the files and update the state',
+    )
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='with --apply, process the files, then the new or written ones as they arrive',
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='run the unfinished jobs of the interrupted apply, without walking and planning again',
+    )
+    parser.add_argument(
+        '--discard-journal', action='store_true',
+        help="start a new apply even if there is an interrupted one, it can't be resumed anymore",
+    )
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='print the timing statistics of the phases',
+    )
+    parser.add_argument(
+        '--stats-file', default=None, metavar='FILE',
+        help='write the timing statistics of the phases in a JSON file',
+    )
+    parser.add_argument(
+        '--events', default=None, metavar='FILE',
+        help='write the events of the jobs as JSON lines in the file',
+    )
+    parser.add_argument(
+        '--profile', default=None, metavar='FILE',
+        help='write the cProfile statistics of the main process in the file',
+    )
     parser.add_argument(
         '--cmds', nargs='*', default=[],
         help='cmds we want to do',
@@ -106,7 +163,37 @@ See also: https://docs.python.org/2/library/re.html#module-contents''')
     args = parser.parse_args()
 
     metatask.init(args.config_file)
-    job_files = []
+    if args.incremental:
+        metatask.config["incremental"] = True
+    if args.force:
+        metatask.config["force"] = True
+    if args.stats or args.stats_file is not None:
+        metatask.config["stats"] = True
+
+    if args.events is not None:
+        open_events(args.events)
+
+    profiler = None
+    if args.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler is None:
+            _run(args)
+        else:
+            profiler.runcall(_run, args)
+    finally:
+        close_events()
+        if profiler is not None:
+            profiler.dump_stats(args.profile)
+        if args.stats:
+            print(get_stats().table())
+        if args.stats_file is not None:
+            with open(args.stats_file, 'w', encoding='utf-8') as f:
+                json.dump(get_stats().summary(), f, indent=4)
+
+
+def _run(args):
     process = Process()
 
     if args.list_cmds:
@@ -123,27 +210,20 @@ See also: https://docs.python.org/2/library/re.html#module-contents''')
         exit()
 
     merge = False
+    merge_by = None
     keep = False
-    cmds = []
-    cmds_config = metatask.config.get("cmds", {})
+    names = []
     if args.task is not None:
         task = metatask.config.get("tasks", {}).get(args.task, {})
-        merge = task.get(merge, False) is True
-        keep = task.get(keep, False) is True
-        for cmd in task.get("cmds", []):
-            if isinstance(cmd, str):
-                c = cmds_config.get(cmd)
-                c["name"] = cmd
-                if c is None:
-                    raise Exception(f"Missing command '{cmd!s}' in `cmds`")
-                cmds.append(c)
-            else:
-                cmds.append(cmd)
+        merge = task.get("merge", False) is True
+        merge_by = task.get("merge_by")
+        keep = task.get("keep", False) is True
+        names = task.get("cmds", [])
     elif args.cmds:
         for cmd in args.cmds:
             rename = re.match("rename/(.+)/(.*)/(.*)", cmd)
             if rename is not None:
-                cmds.append({
+                names.append({
                     "display": "",
                     "name": cmd,
                     "type": "rename",
@@ -152,151 +232,595 @@ See also: https://docs.python.org/2/library/re.html#module-contents''')
                     "flag": rename.group(3)
                 })
             else:
-                c = cmds_config.get(cmd)
-                if c is None:
-                    raise Exception(f"Missing command '{cmd}' in `cmds`")
-                c["name"] = cmd
-                cmds.append(c)
+                names.append(cmd)
+    if args.resume:
+        names, keep, job_files = _resume(args)
+        plan = CommandPlan(names)
+        _apply(args, plan, process, names, keep, job_files)
+        return
+
+    plan = CommandPlan(names)
+    if args.watch:
+        _watch(args, process, plan, keep)
+        return
+    job_files = JobList(plan.tags)
 
     file_list = files(
         args.directory, args.ignore_dir or
         metatask.config.get('ignore_dir', []), args.filename
     )
     if merge:
-        f = file_list[0]
-        if os.path.isfile(f):
-            full_dest, types, messages = _process_file(f, args, process, cmds)
-
-            if 'cmd' not in types:
-                sys.stderr.write(colorize("A merge process should have a cmd", RED))
+        job_files.extend(_plan_groups(file_list, args, process, plan, keep, merge_by))
+    elif args.view:
+        for f, _ in file_list:
+            if os.path.isfile(f):
+                print(json.dumps(read_metadata(f, False), indent=4))
                 exit()
+    elif args.stream and args.apply and not args.dry_run:
+        _check_journal(args)
+        progress = Progress(None, plan, process, keep, args.executor)
+        jobs = _plan_jobs(file_list, args, process, plan, keep)
+        journal = start_journal(names, keep, stream=True)
+        try:
+            progress.run_all(jobs if journal is None else journal.jobs(jobs))
+            # The failed jobs can be resumed
+            close_journal(finished=not progress.failed)
+            _check_failed(progress)
+        except SystemExit:
+            # The planning exits on some errors, there is nothing to resume without job
+            close_journal(finished=journal is not None and journal.nb_jobs == 0)
+            raise
+        finally:
+            close_journal()
+        return
+    else:
+        if args.apply and not args.dry_run:
+            # Before the planning
+            _check_journal(args)
+        job_files.extend(_plan_jobs(file_list, args, process, plan, keep))
 
-            if f != full_dest:
-                print_diff(file_list, full_dest)
-                if os.path.exists(full_dest):
-                    sys.stderr.write(colorize(
-                        "Destination already exists\n", RED
-                    ))
-                    exit()
-            if keep:
-                sys.stderr.write(colorize("The source an the destination are the same in keep mode", RED))
-                exit()
+    _apply(args, plan, process, names, keep, job_files)
 
-            job_files.append((file_list, None))
-    else:
-        dest_files = []
-        for f, _ in file_list:
-            if os.path.isfile(f):
-                try:
-                    full_dest, types, messages, metadata = _process_file(f, args, process, cmds)
 
-                    if types == set():
-                        continue
+def _watch(args, process, plan, keep):
+    """
+    Process the files of the directories, then the new or written ones as they arrive,
+    the configuration, the compiled plan and the exiftool processes stay loaded between them.
+    """
+    if not args.apply or args.dry_run:
+        sys.stderr.write(colorize("The watch mode needs --apply\n", RED))
+        exit()
+    # ctypes is slow to import, only in watch mode
+    from metatask.watch import Watcher
+    ignore_dir = args.ignore_dir or metatask.config.get('ignore_dir', [])
+    # In threads by default, the processes are started for each batch of files
+    executor = args.executor or metatask.config.get("executor", "thread")
+    watcher = Watcher(args.directory, ignore_dir, args.filename)
+    file_list = files(args.directory, ignore_dir, args.filename)
+    try:
+        while True:
+            job_files = JobList(plan.tags)
+            progress = None
+            try:
+                job_files.extend(_plan_jobs(file_list, args, process, plan, keep))
+                if len(job_files) != 0:
+                    progress = Progress(len(job_files), plan, process, keep, executor)
+                    progress.outputs = []
+                    progress.run_all(job_files)
+            except (Exception, SystemExit) as e:
+                # Keep watching, the planning exits on some errors
+                sys.stderr.write(colorize(f"Error while processing the files: '{str(e)}'\n", RED))
+            finally:
+                if progress is not None:
+                    watcher.produced(progress.outputs)
+                job_files.close()
+            filenames = []
+            while not filenames:
+                filenames = watcher.wait()
+            file_list = [(f, os.path.basename(f)) for f in filenames]
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def _check_journal(args):
+    """
+    Refuse to start a new run while there is an interrupted one, unless it's discarded,
+    the runs that are still running don't count.
+    """
+    if metatask.config.get("journal", True) is not True:
+        return
+    if args.discard_journal:
+        discard_journals()
+    elif interrupted_journals():
+        sys.stderr.write(colorize(
+            "There is an interrupted run, resume it with --resume or discard it with --discard-journal\n",
+            RED
+        ))
+        exit()
+
 
-                    if f != full_dest:
-                        print_diff(f, full_dest)
-                        if os.path.exists(full_dest):
-                            sys.stderr.write(colorize(
-                                "Destination already exists\n", RED
-                            ))
-                            if args.delete_size and os.path.getsize(f) == os.path.getsize(full_dest):
-                                if args.apply:
-                                    os.remove(f)
-                                    sys.stderr.write(colorize(
-                                        "The source file is deleted\n", RED
-                                    ))
-                                else:
-                                    sys.stderr.write(colorize(
-                                        "The source file will be removed with the --apply argument\n", RED
-                                    ))
-                            continue
-                        elif len([
-                            i for i in dest_files if i == full_dest
-                        ]) != 0:
-                            sys.stderr.write(colorize(
-                                "Destination will already exists\n", RED
-                            ))
-                            continue
-                    elif keep:
+def _apply(args, plan, process, names, keep, job_files):
+    """
+    Run the planned jobs if confirmed, with a journal to be able to resume them.
+    """
+    try:
+        if len(job_files) != 0 and not args.dry_run and not args.resume:
+            _check_journal(args)
+        if len(job_files) != 0 and not args.dry_run and (args.apply or confirm()):
+            progress = Progress(len(job_files), plan, process, keep, args.executor)
+            start_journal(names, keep, job_files)
+            progress.run_all(job_files)
+            # The failed jobs can be resumed
+            close_journal(finished=not progress.failed)
+            _check_failed(progress)
+    finally:
+        close_journal()
+        job_files.close()
+
+
+def _check_failed(progress):
+    """
+    Exit with an error status if some jobs failed.
+    """
+    if progress.failed:
+        sys.stderr.write(colorize(
+            f"{len(progress.failed)} jobs failed, they can be run again with --resume\n", RED
+        ))
+        sys.exit(1)
+
+
+def _resume(args):
+    """
+    Get the commands, the keep option and the unfinished jobs of the interrupted run,
+    and remove its temporary files (only listed with --dry-run).
+    """
+    path = resume_journal()
+    if path is None:
+        sys.stderr.write(colorize("There is no interrupted run to resume\n", RED))
+        exit()
+    plan_record, jobs, temps = read_journal(path)
+    for temp in temps:
+        if args.dry_run:
+            print(colorize(f"Temporary file of the interrupted run: {temp}", BLUE))
+        else:
+            os.unlink(temp)
+            print(colorize(f"Temporary file of the interrupted run removed: {temp}", BLUE))
+    if plan_record["stream"]:
+        sys.stderr.write(colorize(
+            "The interrupted run was streamed, the files that weren't planned aren't resumed\n", RED
+        ))
+    names = plan_record["names"]
+    tags = CommandPlan(names).tags
+    job_files = JobList(tags)
+    for filenames, metadata in jobs:
+        sources = filenames if isinstance(filenames, list) else [filenames]
+        missing = [f for f in sources if not os.path.isfile(f)]
+        if missing:
+            sys.stderr.write(colorize(f"The file '{missing[0]}' doesn't exist anymore\n", RED))
+            continue
+        if metadata is not None and tags is not None:
+            metadata = LazyMetadata(sources[0], metadata, absent=[tag for tag in tags if tag not in metadata])
+        job_files.append((filenames, metadata))
+    print(colorize(f"{len(job_files)} jobs to resume", GREEN))
+    if len(job_files) == 0 and not args.dry_run:
+        # Nothing left to do
+        release_resumed(remove=True)
+    return names, plan_record["keep"], job_files
+
+
+def _plan_jobs(file_list, args, process, plan, keep):
+    """
+    Plan the files concurrently, print the diffs and the errors in the input order,
+    and yield the (filename, metadata) of the jobs to run.
+    """
+    index = CollisionIndex()
+    renamer = BulkRenamer(plan) if plan.types == {"rename"} else None
+    nb_process = metatask.config.get('nb_process', 8)
+    nb_up_to_date = 0
+    with ThreadPoolExecutor(max_workers=nb_process) as executor:
+        planned = ordered_map(
+            executor,
+            lambda filenames: _plan_files(filenames, args, process, plan, index, renamer),
+            chunks((f for f, _ in file_list), BATCH_SIZE if _need_metadata(args, plan) else BULK_SIZE),
+            nb_process * 2,
+        )
+        for f, result in itertools.chain.from_iterable(planned):
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                if result is None:
+                    nb_up_to_date += 1
+                    continue
+                full_dest, types, messages, metadata, exists = result
+
+                if types == set():
+                    continue
+
+                if f != full_dest:
+                    print_diff(f, full_dest)
+                    if exists:
+                        sys.stderr.write(colorize(
+                            "Destination already exists\n", RED
+                        ))
+                        if args.delete_size and os.path.getsize(f) == os.path.getsize(full_dest):
+                            if args.apply:
+                                os.remove(f)
+                                sys.stderr.write(colorize(
+                                    "The source file is deleted\n", RED
+                                ))
+                            else:
+                                sys.stderr.write(colorize(
+                                    "The source file will be removed with the --apply argument\n", RED
+                                ))
+                        continue
+                    elif index.add(f, full_dest) is not None:
                         sys.stderr.write(colorize(
-                            "The source and the destination are the same in keep mode\n",
-                            RED
+                            "Destination will already exists\n", RED
                         ))
-                        exit()
-                    elif types != {"rename"}:
-                        print(colorize(f, BLUE))
-                        for message in messages:
-                            print(message)
-                    else:
                         continue
-                    job_files.append((f, metadata))
-                    dest_files.append(full_dest)
-                except Exception as e:
+                elif keep:
                     sys.stderr.write(colorize(
-                        f"Error while processing the file '{f}': '{str(e)}'\n",
+                        "The source and the destination are the same in keep mode\n",
                         RED
                     ))
+                    exit()
+                elif types != {"rename"}:
+                    print(colorize(f, BLUE))
+                    for message in messages:
+                        print(message)
+                else:
+                    continue
+                if f == full_dest:
+                    index.add(f, full_dest)
+                yield f, metadata
+            except Exception as e:
+                sys.stderr.write(colorize(
+                    f"Error while processing the file '{f}': '{str(e)}'\n",
+                    RED
+                ))
+
+    if nb_up_to_date != 0:
+        print(colorize(f"{nb_up_to_date} files are up to date", GREEN))
+    for destination, sources in index.conflicts.items():
+        sys.stderr.write(colorize(
+            "The destination '{}' is planned for the files: {}\n".format(
+                destination, ", ".join(f"'{f}'" for f in sources)
+            ),
+            RED
+        ))
+
+
+def _read_chunk_metadata(filenames, tags):
+    """
+    Read the metadata of a chunk of files, on error the files are read one by one,
+    returns a dictionary filename => metadata or exception.
+    """
+    try:
+        return read_metadata_batch(filenames, tags=tags)
+    except Exception:
+        all_metadata = {}
+        for f in filenames:
+            try:
+                all_metadata.update(read_metadata_batch([f], tags=tags))
+            except Exception as e:
+                all_metadata[f] = e
+        return all_metadata
+
+
+def _group_chunk(filenames, tags, need_metadata):
+    filenames = [f for f in filenames if os.path.isfile(f)]
+    all_metadata = _read_chunk_metadata(filenames, tags) if need_metadata else {}
+    return [(f, all_metadata.get(f)) for f in filenames]
+
+
+def _plan_groups(file_list, args, process, plan, keep, merge_by=None):
+    """
+    Partition the files in merge groups, by `directory` or by the value of a metadata tag,
+    all the files are in one group without `merge_by`.
+
+    The files of a group are sorted, the destination is planned from the first one,
+    and the (filenames, metadata) of the merge jobs are yielded in the order of the group keys.
+    """
+    by_tag = merge_by not in (None, "directory")
+    tags = plan.tags
+    if by_tag and tags is not None:
+        tags = sorted(set(tags) | {merge_by})
+    need_metadata = by_tag or _need_metadata(args, plan)
+    groups = {}
+    nb_process = metatask.config.get('nb_process', 8)
+    with ThreadPoolExecutor(max_workers=nb_process) as executor:
+        read = ordered_map(
+            executor,
+            lambda filenames: _group_chunk(filenames, tags, need_metadata),
+            chunks((f for f, _ in file_list), BATCH_SIZE),
+            nb_process * 2,
+        )
+        for f, metadata in itertools.chain.from_iterable(read):
+            if isinstance(metadata, Exception):
+                sys.stderr.write(colorize(
+                    f"Error while reading the metadata of the file '{f}': '{str(metadata)}'\n", RED
+                ))
+                continue
+            if merge_by is None:
+                key = ""
+            elif merge_by == "directory":
+                key = os.path.dirname(f)
+            else:
+                key = None if metadata is None else metadata.get(merge_by)
+                if key is None:
+                    sys.stderr.write(colorize(
+                        f"The file '{f}' has no '{merge_by}' metadata, it isn't merged\n", RED
+                    ))
+                    continue
+                key = str(key)
+            groups.setdefault(key, []).append((f, metadata))
+
+    index = CollisionIndex()
+    for key in sorted(groups):
+        group = sorted(groups[key], key=lambda member: member[0])
+        filenames = [f for f, _ in group]
+        try:
+            full_dest, types, messages, metadata = _process_file(
+                filenames[0], args, process, plan, group[0][1]
+            )
+        except Exception as e:
+            sys.stderr.write(colorize(
+                f"Error while processing the merge of '{filenames[0]}': '{str(e)}'\n", RED
+            ))
+            continue
 
-    if len(job_files) != 0 and not args.dry_run and (args.apply or confirm()):
-        progress = Progress(len(job_files), cmds, process, keep)
-        progress.run_all(job_files)
-
+        if 'cmd' not in types:
+            sys.stderr.write(colorize("A merge process should have a cmd\n", RED))
+            exit()
 
-def _process_file(f, args, process, cmds):
-    try:
-        metadata = None
-        if args.metadata or args.view or len([
-            cmd for cmd in cmds
-            if cmd.get("metadata", False) is True
-        ]) > 0:
-            metadata = read_metadata(f, not args.view)
-            if args.view:
-                print(json.dumps(metadata, indent=4))
+        print_diff(filenames, full_dest)
+        if full_dest in filenames:
+            if keep:
+                sys.stderr.write(colorize("The source an the destination are the same in keep mode\n", RED))
                 exit()
+        elif index.exists(full_dest):
+            sys.stderr.write(colorize("Destination already exists\n", RED))
+            continue
+        elif index.add(filenames[0], full_dest) is not None:
+            sys.stderr.write(colorize("Destination will already exists\n", RED))
+            continue
+        yield filenames, metadata
+
+    for destination, sources in index.conflicts.items():
+        sys.stderr.write(colorize(
+            "The destination '{}' is planned for the merges of: {}\n".format(
+                destination, ", ".join(f"'{f}'" for f in sources)
+            ),
+            RED
+        ))
 
-        full_dest, _, types, messages = process.destination_filename(
-            cmds, f, metadata=metadata
-        )
 
-        return full_dest, types, messages, metadata
+def _need_metadata(args, plan):
+    return args.metadata or plan.need_metadata
 
-    except subprocess.CalledProcessError:
-        sys.stderr.write(f"Error on getting metadata on '{f!s}'.\n")
+
+def _process_file(f, args, process, plan, metadata=None):
+    if metadata is None and _need_metadata(args, plan):
+        metadata = read_metadata(f, tags=plan.tags)
+
+    full_dest, _, types, messages = process.destination_filename(
+        plan, f, metadata=metadata
+    )
+
+    return full_dest, types, messages, metadata
+
+
+def _plan_files(filenames, args, process, plan, index, renamer=None):
+    """
+    Plan a chunk of files in a worker, the metadata of the chunk are read with one exiftool call,
+    only the tags used by the plan are read, and the rename only plans are applied on the whole chunk.
+
+    Returns a list of (filename, result), where result is an exception,
+    (full_dest, types, messages, metadata, destination exists), or None if the file is up to date.
+    """
+    filenames = [f for f in filenames if os.path.isfile(f)]
+    results = []
+    state = get_state()
+    if state is not None and plan.types != {"rename"}:
+        up_to_date = {f for f in filenames if state.up_to_date(f, plan)}
+        results += [(f, None) for f in filenames if f in up_to_date]
+        filenames = [f for f in filenames if f not in up_to_date]
+    all_metadata = {}
+    if _need_metadata(args, plan):
+        all_metadata = _read_chunk_metadata(filenames, plan.tags)
+        errors = {f: e for f, e in all_metadata.items() if isinstance(e, Exception)}
+        results += errors.items()
+        filenames = [f for f in filenames if f not in errors]
+    if renamer is not None:
+        for f, full_dest in zip(filenames, renamer.destinations(filenames, all_metadata)):
+            if isinstance(full_dest, Exception):
+                results.append((f, full_dest))
+            else:
+                exists = f != full_dest and index.exists(full_dest)
+                results.append((f, (full_dest, {"rename"}, [], all_metadata.get(f), exists)))
+        return results
+    for f in filenames:
+        try:
+            full_dest, types, messages, metadata = _process_file(
+                f, args, process, plan, all_metadata.get(f)
+            )
+            exists = f != full_dest and index.exists(full_dest)
+            if exists and state is not None:
+                if state.is_output(f, full_dest):
+                    # The previous output of the file is replaced
+                    exists = False
+                else:
+                    state.forget(f)
+            results.append((f, (full_dest, types, messages, metadata, exists)))
+        except Exception as e:
+            results.append((f, e))
+    return results
 
 
 def init(config_file):
     global config
     if config_file is None:
         config_file = CONFIG_PATH
+    import yaml
     with open(config_file, encoding='utf-8') as f:
         config = yaml.safe_load(f.read())
+    if config.get("precompile_templates", False) is True:
+        precompile_templates(config.get("cmds", {}))
 
 
 class Progress:
-    def __init__(self, nb, cmds, process, keep):
+    def __init__(self, nb, plan, process, keep, executor=None):
         self.nb = nb
         self.no = 0
-        self.cmds = cmds
+        self.plan = plan
         self.process = process
         self.keep = keep
+        self.executor = executor_type(executor, plan)
+        # When it's a list, the produced files are added
+        self.outputs = None
+        # The jobs that failed
+        self.failed = []
+
+    def output(self, result):
+        if self.outputs is not None and result is not None and result[0] is not None:
+            self.outputs.append(result[0])
 
     def run(self, filename, metadata):
-        print(colorize(filename, GREEN))
-        result = self.process.process(self.cmds, [filename], metadata=metadata, keep=self.keep)
-        self.no += 1
-        print(colorize(f"{self.no}/{self.nb}", GREEN))
+        # A list of files for the merges
+        filenames = filename if isinstance(filename, list) else [filename]
+        report("job", files=filenames)
+        try:
+            result = self.process.process(self.plan, filenames, metadata=metadata, keep=self.keep)
+        except CancelledError:
+            # Stays unfinished in the journal
+            return None
+        except Exception as e:
+            job_failed(filenames, e)
+            self.failed.append(filename)
+            return None
+        return self.job_done(filename, result)
+
+    async def run_async(self, executor, filename, metadata):
+        """
+        Like `run` in the event loop of the command runner, see `Process.process_async`.
+        """
+        import asyncio
+        filenames = filename if isinstance(filename, list) else [filename]
+        report("job", files=filenames)
+        try:
+            result = await self.process.process_async(
+                executor, self.plan, filenames, metadata=metadata, keep=self.keep
+            )
+        except (CancelledError, asyncio.CancelledError):
+            # Stays unfinished in the journal
+            return None
+        except Exception as e:
+            job_failed(filenames, e)
+            self.failed.append(filename)
+            return None
+        return await asyncio.get_running_loop().run_in_executor(executor, self.job_done, filename, result)
+
+    def job_done(self, filename, result):
+        journal = get_journal()
+        if journal is not None:
+            journal.done(filename)
+        self.output(result)
+        report("done", files=[filename] if not isinstance(filename, list) else filename)
         return result
 
     def run_all(self, job_files):
-        with ThreadPoolExecutor(
-            max_workers=metatask.config.get('nb_process', 8)
-        ) as executor:
-            future_results = {
-                executor.submit(self.run, f, metadata):
-                f for f, metadata in job_files
-            }
-            for feature in as_completed(future_results):
-                feature.result()
+        """
+        Run the jobs, `job_files` can be a generator, it's consumed only when
+        there is less than two jobs per worker waiting.
+
+        The progress is reported by a `metatask.events.Reporter`.
+        """
+        start_reporter(self.nb)
+        try:
+            if self.executor == "process":
+                self.run_all_processes(job_files)
+            else:
+                self.run_all_threads(job_files)
+        finally:
+            stop_reporter()
+
+    def run_all_threads(self, job_files):
+        """
+        Like `run_all` but in threads, with shell commands the jobs are run in the event loop
+        of the command runner, and the threads are used only for the Python parts of the jobs,
+        then up to `nb_commands` commands run with `nb_process` threads.
+        """
+        nb_process = metatask.config.get('nb_process', 8)
+        with ThreadPoolExecutor(max_workers=nb_process) as executor:
+            nb_pending = nb_process * 2
+            if "cmd" in self.plan.types:
+                runner = get_runner()
+                nb_pending += runner.nb_commands
+
+                def submit(f, metadata):
+                    return runner.submit(self.run_async(executor, f, metadata))
+            else:
+                def submit(f, metadata):
+                    return executor.submit(self.run, f, metadata)
+            pending = set()
+            try:
+                for f, metadata in job_files:
+                    if len(pending) >= nb_pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for feature in done:
+                            feature.result()
+                    pending.add(submit(f, metadata))
+                for feature in as_completed(pending):
+                    feature.result()
+            except KeyboardInterrupt:
+                self.process.stop()
+                executor.shutdown(cancel_futures=True)
+                raise
+            finally:
+                # The jobs in the event loop aren't stopped with the executor
+                wait(pending)
+
+    def chunk_done(self, feature):
+        results, failed, durations, events = feature.result()
+        self.failed += failed
+        if durations is not None:
+            get_stats().merge(durations)
+        get_reporter().merge(events)
+        for result in results:
+            self.output(result)
+
+    def run_all_processes(self, job_files):
+        """
+        Like `run_all` but in worker processes, the jobs are sent by chunks.
+        """
+        # multiprocessing is slow to import
+        from concurrent.futures import ProcessPoolExecutor
+        nb_process = metatask.config.get('nb_process', 8)
+        lock = lock_path()
+        commit_cache()
+        commit_state()
+        try:
+            with ProcessPoolExecutor(
+                max_workers=nb_process, initializer=init_worker,
+                initargs=(
+                    metatask.config, self.plan, self.keep, lock,
+                    None if get_journal() is None else get_journal().path,
+                ),
+            ) as executor:
+                pending = set()
+                for chunk in chunks(job_files, CHUNK_SIZE):
+                    if len(pending) >= nb_process * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for feature in done:
+                            self.chunk_done(feature)
+                    pending.add(executor.submit(run_chunk, chunk))
+                for feature in as_completed(pending):
+                    self.chunk_done(feature)
+        finally:
+            if os.path.exists(lock):
+                os.unlink(lock)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,367 @@
+"""
+Benchmark the walk, plan and execute phases of metatask on a synthetic tree,
+with an exiftool stand-in, and print the results as JSON.
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import metatask
+import metatask.fake_exiftool
+from metatask.process import Process
+from metatask.plan import CommandPlan, RenameStep
+from metatask.bulk import plan_renames
+from metatask.jobs import JobList
+from metatask.stats import rss
+from metatask.utils import files, read_metadata, read_metadata_batch, chunks
+from metatask.exiftool import BATCH_SIZE, close_exiftool
+
+
+PHASES = [
+    "startup", "walk", "read_metadata", "read_metadata_batch", "destination_filename", "plan_renames",
+    "job_list", "format_regex", "format_metadata", "format_jinja", "run_all_thread", "run_all_process",
+]
+
+# Should not be imported by `import metatask`
+HEAVY_MODULES = ["PyQt5", "jinja2", "yaml", "asyncio", "multiprocessing"]
+STARTUP_SCRIPT = f"""
+import sys, json, time
+start = time.perf_counter()
+import metatask
+print(json.dumps([time.perf_counter() - start, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))
+"""
+
+CMDS = {
+    "date": {
+        "type": "rename",
+        "metadata": True,
+        "from": r"IMG_([0-9]+)\.jpg$",
+        "to": r"{DateTimeOriginal:%Y}/{DateTimeOriginal:%m}/{Make}-\1.jpg",
+    },
+    "jinja": {
+        "type": "rename",
+        "metadata": True,
+        "template": "jinja",
+        "from": r"([0-9]+)\.jpg$",
+        "to": r"{{ DateTimeOriginal.year }}-{{ format_num_on_demon(m.FNumber | int) }}-\1.jpg",
+    },
+    "upper": {
+        "type": "rename",
+        "from": r"[a-z]+$",
+        "format": "upper",
+    },
+    "number": {
+        "type": "rename",
+        "from": r"IMG_([0-9]+)\.JPG$",
+        "to": r"\1.jpg",
+    },
+    "move": {
+        "type": "rename",
+        "from": "^(.*)/tree/",
+        "to": r"\1/moved/",
+    },
+}
+
+
+def generate_tree(root, nb_files, depth, files_per_directory=50, ignore_dirs=(), size=1024):
+    """
+    Generate `nb_files` files spread in directories `depth` levels deep,
+    and a directory per ignore name in every tenth directory.
+    """
+    nb_directories = max(1, math.ceil(nb_files / files_per_directory))
+    fanout = max(2, math.ceil(nb_directories ** (1 / max(depth, 1))))
+    content = bytes(range(256)) * (size // 256 + 1)
+    for no_directory in range(nb_directories):
+        parts = []
+        number = no_directory
+        for _ in range(depth):
+            parts.append(f"d{number % fanout}")
+            number //= fanout
+        directory = os.path.join(root, *reversed(parts))
+        os.makedirs(directory, exist_ok=True)
+        first = no_directory * files_per_directory
+        for no in range(first, min(first + files_per_directory, nb_files)):
+            with open(os.path.join(directory, f"IMG_{no:06d}.jpg"), "wb") as f:
+                f.write(content[:size])
+        if no_directory % 10 == 0:
+            for name in ignore_dirs:
+                os.makedirs(os.path.join(directory, name), exist_ok=True)
+                for no in range(files_per_directory):
+                    with open(os.path.join(directory, name, f"IMG_{no:06d}.jpg"), "wb") as f:
+                        f.write(content[:size])
+
+
+def fake_exiftool(directory, latency=0, file_latency=0):
+    """
+    Write a script that starts the exiftool stand-in with the latencies.
+    """
+    path = os.path.join(directory, "exiftool")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(
+            f"#!/bin/sh\nexec '{sys.executable}' '{metatask.fake_exiftool.__file__}' "
+            f"--latency={latency} --file-latency={file_latency} \"$@\"\n"
+        )
+    os.chmod(path, 0o755)
+    return path
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Redirect the standard output to /dev/null, also for the worker processes.
+    """
+    sys.stdout.flush()
+    stdout = os.dup(1)
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(stdout, 1)
+        os.close(stdout)
+
+
+class Benchmark:
+    """
+    Run the phases on a synthetic tree, each phase is run `repeat` times and the best time is kept.
+    """
+
+    def __init__(self, directory, options):
+        self.directory = directory
+        self.options = options
+        self.root = os.path.join(directory, "tree")
+        self.ignore = [re.escape(name) + "$" for name in options.ignore_dirs]
+        self.results = {}
+        # Measures added to the results of the phases
+        self.extra = {}
+        self._filenames = None
+        self._metadata = None
+
+    def generate(self):
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        moved = os.path.join(self.directory, "moved")
+        if os.path.exists(moved):
+            shutil.rmtree(moved)
+        generate_tree(
+            self.root, self.options.files, self.options.depth, self.options.files_per_directory,
+            self.options.ignore_dirs, self.options.size,
+        )
+
+    def measure(self, name, function, setup=None):
+        runs = []
+        count = 0
+        for _ in range(self.options.repeat):
+            if setup is not None:
+                setup()
+            with quiet():
+                start = time.perf_counter()
+                count = function()
+                runs.append(time.perf_counter() - start)
+        best = min(runs)
+        self.results[name] = {
+            "count": count,
+            "seconds": best,
+            "per_second": count / best if best > 0 else None,
+            "runs": runs,
+        }
+        self.results[name].update(self.extra.pop(name, {}))
+
+    @property
+    def filenames(self):
+        if self._filenames is None:
+            self._filenames = [f for f, _ in files([self.root], self.ignore)]
+        return self._filenames
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = read_metadata_batch(self.filenames)
+        return self._metadata
+
+    def startup(self):
+        """
+        Time `import metatask` in a new interpreter, and list the heavy modules it imports.
+        """
+        runs = []
+        modules = []
+        for _ in range(self.options.repeat):
+            duration, modules = json.loads(subprocess.check_output([sys.executable, "-c", STARTUP_SCRIPT]))
+            runs.append(duration)
+        self.results["startup"] = {
+            "count": 1,
+            "seconds": min(runs),
+            "per_second": 1 / min(runs),
+            "runs": runs,
+            "heavy_modules": modules,
+        }
+
+    def walk(self):
+        return len(list(files([self.root], self.ignore)))
+
+    def read_metadata(self):
+        sample = self.filenames[:self.options.sample]
+        for filename in sample:
+            read_metadata(filename)
+        return len(sample)
+
+    def read_metadata_batch(self):
+        for filenames in chunks(self.filenames, BATCH_SIZE):
+            read_metadata_batch(filenames)
+        return len(self.filenames)
+
+    def destination_filename(self):
+        process = Process()
+        plan = CommandPlan(["date", "jinja", "upper"])
+        for filename in self.filenames:
+            process.destination_filename(plan, filename, metadata=self.metadata[filename])
+        return len(self.filenames)
+
+    def plan_renames(self):
+        plan_renames(CommandPlan(["upper", "number"]), self.filenames)
+        return len(self.filenames)
+
+    def job_list(self):
+        """
+        Plan the jobs with all the metadata, the growth of the resident memory per file is kept.
+        """
+        jobs = JobList()
+        before = rss()
+        for filenames in chunks(self.filenames, BATCH_SIZE):
+            jobs.extend(read_metadata_batch(filenames).items())
+        rss_per_file = (rss() - before) / len(self.filenames)
+        for _ in jobs:
+            pass
+        jobs.close()
+        extra = self.extra.setdefault("job_list", {})
+        extra["rss_per_file"] = max(extra.get("rss_per_file", 0), rss_per_file)
+        return len(self.filenames)
+
+    def _format(self, config):
+        step = RenameStep(config)
+        for filename in self.filenames:
+            step.apply(filename, self.metadata[filename])
+        return len(self.filenames)
+
+    def format_regex(self):
+        return self._format({"from": r"IMG_([0-9]+)\.jpg$", "to": r"\1-IMG.jpg"})
+
+    def format_metadata(self):
+        return self._format(CMDS["date"])
+
+    def format_jinja(self):
+        return self._format(CMDS["jinja"])
+
+    def _run_all(self, executor):
+        plan = CommandPlan(["move"])
+        job_files = [(filename, None) for filename in self.filenames]
+        progress = metatask.Progress(len(job_files), plan, Process(), False, executor)
+        progress.run_all(job_files)
+        return len(job_files)
+
+    def run_all_thread(self):
+        return self._run_all("thread")
+
+    def run_all_process(self):
+        return self._run_all("process")
+
+    def run(self, phases):
+        if set(phases) - {"startup"}:
+            self.generate()
+        for phase in phases:
+            if phase == "startup":
+                self.startup()
+            elif phase.startswith("run_all_"):
+                # The files are moved
+                self.measure(phase, getattr(self, phase), self.generate)
+                self.generate()
+            else:
+                self.measure(phase, getattr(self, phase))
+        return self.results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=2000, help="number of files")
+    parser.add_argument("--depth", type=int, default=3, help="depth of the directories")
+    parser.add_argument("--files-per-directory", type=int, default=50, help="number of files per directory")
+    parser.add_argument("--size", type=int, default=1024, help="size of the files, in bytes")
+    parser.add_argument(
+        "--ignore-dirs", nargs="*", default=["@eaDir", ".git"],
+        help="names of the ignored directories created in the tree",
+    )
+    parser.add_argument("--latency", type=float, default=0, help="exiftool latency per command, in seconds")
+    parser.add_argument("--file-latency", type=float, default=0, help="exiftool latency per file, in seconds")
+    parser.add_argument("--sample", type=int, default=100, help="number of files read one by one")
+    parser.add_argument("--nb-process", type=int, default=os.cpu_count() or 1, help="number of workers")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs, the best is kept")
+    parser.add_argument("--phases", nargs="*", choices=PHASES, default=PHASES, help="phases to run")
+    parser.add_argument(
+        "--directory", help="directory where the tree is generated, default is a temporary one",
+    )
+    parser.add_argument("--output", help="JSON output file, default is the standard output")
+    parser.add_argument(
+        "--max-startup", type=float,
+        help="fail if `import metatask` is longer, in seconds, or if it imports a heavy module",
+    )
+    options = parser.parse_args()
+
+    directory = options.directory or tempfile.mkdtemp(prefix="metatask-benchmark-")
+    os.makedirs(directory, exist_ok=True)
+    try:
+        metatask.config = {
+            "exiftool": fake_exiftool(directory, options.latency, options.file_latency),
+            "nb_process": options.nb_process,
+            "cache": False,
+            "executor": "thread",
+            "cmds": CMDS,
+        }
+        try:
+            results = Benchmark(directory, options).run(options.phases)
+        finally:
+            close_exiftool()
+    finally:
+        if options.directory is None:
+            shutil.rmtree(directory)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {
+            name: getattr(options, name) for name in (
+                "files", "depth", "files_per_directory", "size", "ignore_dirs",
+                "latency", "file_latency", "sample", "nb_process", "repeat",
+            )
+        },
+        "results": results,
+    }
+    if options.output is None:
+        print(json.dumps(report, indent=4))
+    else:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+
+    startup = results.get("startup")
+    if options.max_startup is not None and startup is not None:
+        if startup["seconds"] > options.max_startup or startup["heavy_modules"]:
+            sys.stderr.write(
+                "The startup is too slow: {seconds:.3f}s, imported modules: {modules}\n".format(
+                    seconds=startup["seconds"], modules=", ".join(startup["heavy_modules"]) or "none",
+                )
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
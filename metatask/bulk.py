@@ -0,0 +1,178 @@
+import re
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # pragma: no cover
+    import sre_parse
+    import sre_constants
+from metatask.plan import replace_extension
+from metatask.collision import CollisionIndex
+
+
+SLASH = ord("/")
+# Maximum number of transformed basenames kept by step
+MEMO_SIZE = 100000
+# Number of files planned together when no metadata are needed
+BULK_SIZE = 1024
+
+
+def _class_matches_slash(items):
+    negate = False
+    contains = False
+    for op, av in items:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            contains = contains or av == SLASH
+        elif op == sre_constants.RANGE:
+            contains = contains or av[0] <= SLASH <= av[1]
+        elif op == sre_constants.CATEGORY:
+            # The digit, word and space categories don't contain the slash, their negations do
+            contains = contains or "NOT" in str(av)
+        else:
+            return True
+    return contains != negate
+
+
+def _matches_slash(items):
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            if av == SLASH:
+                return True
+        elif op == sre_constants.NOT_LITERAL:
+            if av != SLASH:
+                return True
+        elif op == sre_constants.IN:
+            if _class_matches_slash(av):
+                return True
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) or \
+                str(op) == "POSSESSIVE_REPEAT":
+            if _matches_slash(av[2]):
+                return True
+        elif op == sre_constants.SUBPATTERN:
+            if _matches_slash(av[-1]):
+                return True
+        elif str(op) == "ATOMIC_GROUP":
+            if _matches_slash(av):
+                return True
+        elif op == sre_constants.BRANCH:
+            if any(_matches_slash(branch) for branch in av[1]):
+                return True
+        elif op == sre_constants.GROUPREF_EXISTS:
+            if _matches_slash(av[1]) or av[2] is not None and _matches_slash(av[2]):
+                return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            # What follows the basename is the same, but not what precedes it
+            if av[0] < 0:
+                return True
+        elif op == sre_constants.AT:
+            if av in (sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING):
+                return True
+        elif op != sre_constants.GROUPREF:
+            return True
+    return False
+
+
+def _split(path):
+    """
+    Split the path in the directory with its trailing slashes, kept verbatim, and the basename.
+    """
+    index = path.rfind("/") + 1
+    return path[:index], path[index:]
+
+
+def basename_only(regexp):
+    """
+    Check if the compiled regular expression can only change the basename of a path: it's anchored
+    at the end, and it can't match a slash, then `sub` can be applied on the basename alone.
+    """
+    if not isinstance(regexp.pattern, str) or regexp.flags & re.MULTILINE:
+        return False
+    try:
+        items = list(sre_parse.parse(regexp.pattern, regexp.flags))
+    except Exception:
+        return False
+    if not items or items[-1] not in (
+        (sre_constants.AT, sre_constants.AT_END), (sre_constants.AT, sre_constants.AT_END_STRING)
+    ):
+        return False
+    return not _matches_slash(items)
+
+
+class BulkRenamer:
+    """
+    Apply the rename steps of a plan on many files, step by step.
+
+    The steps that only change the basename are applied once per distinct basename,
+    and the directories are shared between the paths, the steps that use the metadata
+    are applied file by file.
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.steps = [
+            (step, not step.metadata and basename_only(step.from_re))
+            for cmd in plan.commands if cmd.type == "rename"
+            for step in cmd.steps
+        ]
+        self._memos = [{} for _ in self.steps]
+
+    def destinations(self, filenames, all_metadata=None):
+        """
+        Get the destination of each file, or the exception raised while renaming it.
+        """
+        if all_metadata is None:
+            all_metadata = {}
+        directories = {}
+        paths = []
+        for filename in filenames:
+            directory, name = _split(filename)
+            paths.append((directories.setdefault(directory, directory), name))
+        errors = {}
+        for (step, local), memo in zip(self.steps, self._memos):
+            if len(memo) > MEMO_SIZE:
+                memo.clear()
+            for index, (directory, name) in enumerate(paths):
+                if index in errors:
+                    continue
+                try:
+                    if local:
+                        new_name = memo.get(name)
+                        if new_name is None:
+                            new_name = memo[name] = step.apply(name, None)
+                        paths[index] = (directory, new_name)
+                    else:
+                        path = step.apply(directory + name, all_metadata.get(filenames[index]))
+                        directory, name = _split(path)
+                        paths[index] = (directories.setdefault(directory, directory), name)
+                except Exception as e:
+                    errors[index] = e
+        results = []
+        for index, (directory, name) in enumerate(paths):
+            if index in errors:
+                results.append(errors[index])
+            else:
+                path = directory + name
+                if self.plan.out_ext is not None:
+                    path = replace_extension(path, self.plan.out_ext)
+                results.append(path)
+        return results
+
+
+def plan_renames(plan, filenames, all_metadata=None, index=None):
+    """
+    Plan the renames of many files, returns the sources, their destinations (or the exception raised
+    while renaming them), the destinations that already exist and the collision index,
+    where `conflicts` is the destinations planned for many sources.
+    """
+    if index is None:
+        index = CollisionIndex()
+    destinations = BulkRenamer(plan).destinations(filenames, all_metadata)
+    existing = []
+    for source, destination in zip(filenames, destinations):
+        if isinstance(destination, Exception) or source == destination:
+            continue
+        if index.exists(destination):
+            existing.append(destination)
+        else:
+            index.add(source, destination)
+    return filenames, destinations, existing, index
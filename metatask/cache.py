@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import threading
+import metatask
+
+
+CACHE_FILENAME = "metatask.sqlite"
+
+if 'LOCALAPPDATA' in os.environ:
+    CACHE_PATH = os.path.join(os.environ['LOCALAPPDATA'], 'metatask', CACHE_FILENAME)
+elif 'XDG_CACHE_HOME' in os.environ:
+    CACHE_PATH = os.path.join(os.environ['XDG_CACHE_HOME'], 'metatask', CACHE_FILENAME)
+else:
+    CACHE_PATH = os.path.join(os.environ['HOME'], '.cache', 'metatask', CACHE_FILENAME)
+
+# Number of operations or seconds between two commits
+COMMIT_INTERVAL = 1000
+COMMIT_DELAY = 1
+# The paths are stored as bytes since the version 2
+SCHEMA_VERSION = 2
+# The tags that depend on the path, rewritten when a file is renamed
+PATH_TAGS = ("SourceFile", "FileName", "Directory")
+
+
+class MetadataCache:
+    """
+    Persistent cache of the raw exiftool JSON.
+
+    The entries are keyed by the real path (as bytes, the filenames can be in any encoding) and are
+    valid only if the size, the modification time and the inode of the file didn't change.
+    An entry can contain only some tags, they are listed in the `tags` column.
+    When there is more than `max_size` entries, the least recently used are removed.
+
+    The writes are buffered and committed in short transactions, so the cache can be shared
+    between processes.
+    """
+
+    def __init__(self, path=None, max_size=None):
+        if path is None:
+            path = metatask.config.get("cache_path", CACHE_PATH)
+        if max_size is None:
+            max_size = metatask.config.get("cache_size", 100000)
+        self.max_size = max_size
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._statements = []
+        self._pending = {}
+        self._last_commit = time.monotonic()
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self._connection.execute("DROP TABLE IF EXISTS metadata")
+            self._connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+            "data TEXT, tags TEXT, accessed INTEGER)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS metadata_accessed ON metadata (accessed)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def _key(filename):
+        stat = os.stat(filename)
+        return os.fsencode(os.path.realpath(filename)), stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def _get(self, path, size, mtime_ns, inode):
+        row = self._pending.get(path)
+        if row is not None and row[1:4] == (size, mtime_ns, inode):
+            row = row[4:6]
+        else:
+            row = self._connection.execute(
+                "SELECT data, tags FROM metadata WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                (path, size, mtime_ns, inode),
+            ).fetchone()
+        if row is None:
+            return None, None
+        return json.loads(row[0]), None if row[1] is None else set(json.loads(row[1]))
+
+    def get(self, filename, tags=None):
+        """
+        Get the metadata of the file, if `tags` is not None we just need these tags.
+        """
+        try:
+            key = self._key(filename)
+        except OSError:
+            return None
+        with self._lock:
+            metadata, cached_tags = self._get(*key)
+            if metadata is None:
+                return None
+            if cached_tags is not None and (tags is None or not cached_tags.issuperset(tags)):
+                return None
+            self._write("UPDATE metadata SET accessed = ? WHERE path = ?", (time.time_ns(), key[0]))
+        return metadata
+
+    def put(self, filename, metadata, tags=None):
+        """
+        Store the metadata of the file, if `tags` is not None the metadata contains only these tags,
+        and they are merged with the already cached tags.
+        """
+        try:
+            key = self._key(filename)
+        except OSError:
+            return
+        with self._lock:
+            if tags is not None:
+                tags = set(tags)
+                cached_metadata, cached_tags = self._get(*key)
+                if cached_metadata is not None:
+                    cached_metadata.update(metadata)
+                    metadata = cached_metadata
+                    tags = None if cached_tags is None else tags | cached_tags
+            row = key + (
+                json.dumps(metadata), None if tags is None else json.dumps(sorted(tags)), time.time_ns()
+            )
+            self._pending[key[0]] = row
+            self._write("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+
+    def rename(self, source, destination):
+        """
+        Carry over the entry of a renamed file, should be called after the move.
+        """
+        try:
+            path, size, mtime_ns, inode = self._key(destination)
+        except OSError:
+            return
+        source = os.fsencode(os.path.realpath(source))
+        with self._lock:
+            row = self._pending.pop(source, None)
+            if row is not None:
+                row = (row[1], row[4], row[5])
+            else:
+                row = self._connection.execute(
+                    "SELECT size, data, tags FROM metadata WHERE path = ?", (source,)
+                ).fetchone()
+            self._write("DELETE FROM metadata WHERE path IN (?, ?)", (source, path))
+            self._pending.pop(path, None)
+            if row is None or row[0] != size:
+                return
+            metadata = json.loads(row[1])
+            values = (destination, os.path.basename(destination), os.path.dirname(destination) or ".")
+            for tag, value in zip(PATH_TAGS, values):
+                if tag in metadata:
+                    metadata[tag] = value
+            row = (path, size, mtime_ns, inode, json.dumps(metadata), row[2], time.time_ns())
+            self._pending[path] = row
+            self._write("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+
+    def _write(self, sql, params):
+        self._statements.append((sql, params))
+        if len(self._statements) >= COMMIT_INTERVAL or time.monotonic() - self._last_commit > COMMIT_DELAY:
+            self.commit()
+
+    def commit(self):
+        with self._connection:
+            for sql, params in self._statements:
+                self._connection.execute(sql, params)
+            nb, = self._connection.execute("SELECT COUNT(*) FROM metadata").fetchone()
+            if nb > self.max_size:
+                self._connection.execute(
+                    "DELETE FROM metadata WHERE path IN "
+                    "(SELECT path FROM metadata ORDER BY accessed LIMIT ?)",
+                    (nb - self.max_size,),
+                )
+        self._statements = []
+        self._pending = {}
+        self._last_commit = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self._connection.close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Get the shared metadata cache, None if it's disabled in the configuration.
+    """
+    global _cache
+    if metatask.config.get("cache", True) is not True:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = MetadataCache()
+            atexit.register(close_cache)
+        return _cache
+
+
+def close_cache():
+    """
+    Commit and close the shared metadata cache if it's open.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is not None:
+            _cache.close()
+            _cache = None
+
+
+def reset_cache():
+    """
+    Forget the metadata cache of the parent without closing it, in a forked worker process.
+    """
+    global _cache, _cache_lock
+    _cache = None
+    _cache_lock = threading.Lock()
+
+
+def commit_cache():
+    """
+    Commit the pending writes of the shared metadata cache, e.g. before starting other processes.
+    """
+    with _cache_lock:
+        if _cache is not None:
+            with _cache._lock:
+                _cache.commit()
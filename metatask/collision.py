@@ -0,0 +1,75 @@
+import os
+import array
+import hashlib
+import threading
+import collections
+
+
+class CollisionIndex:
+    """
+    Detect the destinations that already exist or that are planned twice, in constant time.
+
+    The planned destinations are stored as 16 bytes digests, with the number of their source,
+    the sources are stored encoded in one buffer, and the existence checks use a listing of the
+    destination directories, read once and kept for the `max_directories` most recently used
+    directories.
+    """
+
+    def __init__(self, max_directories=1024):
+        self.max_directories = max_directories
+        self.conflicts = {}
+        self._planned = {}
+        self._sources = bytearray()
+        self._offsets = array.array('Q', [0])
+        self._listings = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(destination):
+        return hashlib.blake2b(
+            destination.encode('utf-8', errors='surrogateescape'), digest_size=16
+        ).digest()
+
+    def _source(self, number):
+        return self._sources[self._offsets[number]:self._offsets[number + 1]].decode(
+            'utf-8', errors='surrogateescape'
+        )
+
+    def exists(self, destination):
+        """
+        Check if the destination file already exists.
+        """
+        directory, name = os.path.split(destination)
+        with self._lock:
+            listing = self._listings.get(directory)
+            if listing is not None:
+                self._listings.move_to_end(directory)
+                return name in listing
+        try:
+            listing = frozenset(os.listdir(directory or '.'))
+        except OSError:
+            listing = frozenset()
+        with self._lock:
+            self._listings[directory] = listing
+            while len(self._listings) > self.max_directories:
+                self._listings.popitem(last=False)
+        return name in listing
+
+    def add(self, source, destination):
+        """
+        Plan the destination for the source, returns the source already planned
+        for this destination, or None if it's free.
+        """
+        digest = self._digest(destination)
+        with self._lock:
+            number = self._planned.get(digest)
+            if number is None:
+                self._planned[digest] = len(self._offsets) - 1
+                self._sources += source.encode('utf-8', errors='surrogateescape')
+                self._offsets.append(len(self._sources))
+                return None
+            first = self._source(number)
+            if first == source:
+                return None
+            self.conflicts.setdefault(destination, [first]).append(source)
+            return first
@@ -0,0 +1,221 @@
+import sys
+import json
+import time
+import queue
+import threading
+from bashcolor import colorize, RED, BLUE, GREEN, YELLOW
+
+
+# Seconds between two refreshes of the status line
+STATUS_INTERVAL = 0.2
+_STOP = object()
+
+
+def format_event(event):
+    """
+    Get the text of an event for the terminal, None if it's not shown.
+    """
+    type_ = event["type"]
+    if type_ == "job":
+        return colorize(", ".join(event["files"]), GREEN)
+    if type_ == "command":
+        return "{name}: {cmd}".format(name=colorize(event["name"], BLUE), cmd=event["cmd"])
+    if type_ == "metadata":
+        return "{name}: {tags}".format(
+            name=colorize(event["name"], BLUE),
+            tags=", ".join(f"{tag}={value}" for tag, value in event["tags"].items()),
+        )
+    if type_ == "copy":
+        return "{name}: {file}".format(
+            name=colorize("copy", BLUE), file=colorize(event["destination"], YELLOW),
+        )
+    if type_ == "error":
+        return colorize(event["message"], RED)
+    return None
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class Reporter:
+    """
+    The progress of the running jobs.
+
+    The workers put their events in a queue, and one thread counts the finished jobs, writes the
+    messages in batches, the count with the throughput and the ETA (at most every `interval` seconds,
+    in a status line on a terminal), and the events as JSON lines in the `events` stream.
+    """
+
+    def __init__(self, nb=None, events=None, status=None, interval=STATUS_INTERVAL, output=None):
+        self.nb = nb
+        self.no = 0
+        self.events = events
+        self.output = sys.stdout if output is None else output
+        # Without the number of jobs the files are planned while they run, and the diffs are printed
+        self.status = self.output.isatty() and nb is not None if status is None else status
+        self.interval = interval
+        self._queue = queue.SimpleQueue()
+        self._start = time.monotonic()
+        self._last_status = 0
+        self._shown_no = 0
+        self._status_text = ""
+        self._thread = threading.Thread(target=self._run, name="metatask-progress", daemon=True)
+        self._thread.start()
+
+    def event(self, type_, **values):
+        values["type"] = type_
+        values.setdefault("time", time.time())
+        self._queue.put(values)
+
+    def merge(self, events):
+        """
+        Add the events collected in a worker process.
+        """
+        for event in events:
+            self._queue.put(event)
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            try:
+                batch = [self._queue.get(timeout=self.interval)]
+            except queue.Empty:
+                batch = []
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            records = []
+            for event in batch:
+                if event is _STOP:
+                    stopped = True
+                    continue
+                if event["type"] == "done":
+                    self.no += 1
+                text = format_event(event)
+                if text is not None:
+                    lines.append(text)
+                if self.events is not None:
+                    records.append(json.dumps(event, default=str) + "\n")
+            if records:
+                self.events.write("".join(records))
+                self.events.flush()
+            self._write(lines, stopped)
+
+    def _status(self, now):
+        elapsed = now - self._start
+        rate = self.no / elapsed if elapsed > 0 else 0
+        if self.nb is None:
+            return colorize(f"{self.no}, {rate:.1f}/s", GREEN)
+        eta = format_duration((self.nb - self.no) / rate) if rate > 0 else "?"
+        return colorize(f"{self.no}/{self.nb}, {rate:.1f}/s, ETA {eta}", GREEN)
+
+    def _write(self, lines, final=False):
+        now = time.monotonic()
+        refresh = (final or now - self._last_status >= self.interval) and self.no != self._shown_no
+        if refresh:
+            self._status_text = self._status(now)
+            self._shown_no = self.no
+            self._last_status = now
+        parts = []
+        if self.status:
+            if lines or refresh:
+                # Replace the status line
+                parts.append("\r\x1b[K")
+                parts.extend(line + "\n" for line in lines)
+                parts.append(self._status_text)
+            if final and self._status_text:
+                parts.append("\n")
+        else:
+            parts.extend(line + "\n" for line in lines)
+            if refresh:
+                parts.append(self._status_text + "\n")
+        if parts:
+            self.output.write("".join(parts))
+            self.output.flush()
+
+    def stop(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+
+class Collector:
+    """
+    The events of a worker process, sent with the results of its jobs.
+    """
+
+    def __init__(self):
+        self._events = []
+
+    def event(self, type_, **values):
+        values["type"] = type_
+        values.setdefault("time", time.time())
+        self._events.append(values)
+
+    def drain(self):
+        events = self._events
+        self._events = []
+        return events
+
+
+_reporter = None
+_events = None
+
+
+def report(type_, **values):
+    """
+    Report an event to the current reporter, or print it if there is none.
+    """
+    reporter = _reporter
+    if reporter is not None:
+        reporter.event(type_, **values)
+        return
+    text = format_event(dict(values, type=type_))
+    if text is not None:
+        print(text)
+
+
+def start_reporter(nb=None):
+    global _reporter
+    _reporter = Reporter(nb, _events)
+    return _reporter
+
+
+def stop_reporter():
+    global _reporter
+    if isinstance(_reporter, Reporter):
+        _reporter.stop()
+    _reporter = None
+
+
+def collect_events():
+    """
+    Collect the events, in a worker process.
+    """
+    global _reporter
+    _reporter = Collector()
+    return _reporter
+
+
+def get_reporter():
+    return _reporter
+
+
+def open_events(path):
+    """
+    Write the events of the next runs as JSON lines in the file.
+    """
+    global _events
+    _events = open(path, "a", encoding="utf-8")
+
+
+def close_events():
+    global _events
+    if _events is not None:
+        _events.close()
+        _events = None
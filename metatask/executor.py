@@ -0,0 +1,119 @@
+import os
+import sys
+import tempfile
+import metatask
+from metatask.process import Process
+from metatask.utils import StripedLock, fcntl
+from metatask.cache import close_cache, reset_cache
+from metatask.state import close_state, reset_state
+from metatask.exiftool import close_exiftool, reset_exiftool
+from metatask.journal import get_journal, open_journal, close_journal
+from metatask.stats import get_stats, reset_stats
+from metatask.events import report, collect_events, get_reporter
+from concurrent.futures import CancelledError
+
+
+EXECUTORS = ["thread", "process", "auto"]
+# Number of jobs sent together to a worker process
+CHUNK_SIZE = 64
+
+_process = None
+_plan = None
+_keep = False
+
+
+def executor_type(name, plan):
+    """
+    Get the executor to use for a plan: `thread` or `process`.
+
+    With `auto` the processes are used for the rename only plans, where the time is spent
+    in the Python regexps and templates, and the threads for the shell commands.
+    """
+    if name is None:
+        name = metatask.config.get("executor", "auto")
+    if name not in EXECUTORS:
+        raise Exception(f"Unknown executor '{name}', should be one of: {', '.join(EXECUTORS)}")
+    if name == "auto":
+        name = "process" if plan.types == {"rename"} and fcntl is not None else "thread"
+    if name == "process" and fcntl is None:
+        raise Exception("The process executor is not supported on this platform")
+    if name == "process" and "cmd" in plan.types and metatask.config.get("resources"):
+        # Each worker process would have its own budgets
+        raise Exception("The resources budgets are not supported with the process executor")
+    return name
+
+
+def lock_path():
+    return os.path.join(tempfile.gettempdir(), f"metatask-{os.getpid()}.lock")
+
+
+def init_worker(config, plan, keep, lock, journal=None):
+    """
+    Initialize a worker process, the plan is sent only once per worker.
+    """
+    import multiprocessing.util
+    global _process, _plan, _keep
+    metatask.config = config
+    # The SQLite connections, the exiftool processes and the runner thread of the parent can't be
+    # used in a forked process, and closing them would stop the ones of the parent
+    reset_cache()
+    reset_state()
+    reset_exiftool()
+    if "metatask.runner" in sys.modules:
+        sys.modules["metatask.runner"].reset_runner()
+    reset_stats()
+    collect_events()
+    _process = Process()
+    _plan = plan
+    _keep = keep
+    # Shared between the worker processes
+    Process.locks = StripedLock(path=lock)
+    open_journal(journal)
+    multiprocessing.util.Finalize(None, close_worker, exitpriority=10)
+
+
+def close_worker():
+    from metatask.runner import close_runner
+    close_runner()
+    close_exiftool()
+    close_cache()
+    close_state()
+    close_journal()
+
+
+def job_failed(filenames, error):
+    """
+    Report the error of a job, the job is finished and the others continue.
+    """
+    report("error", message="Error while processing the file '{}': '{!s}'".format(
+        "', '".join(filenames), error
+    ), files=filenames)
+    report("done", files=filenames)
+
+
+def run_chunk(job_files):
+    """
+    Process a chunk of jobs in a worker process, returns the results, the failed jobs,
+    the statistics of the worker if they are enabled, and its events.
+    """
+    results = []
+    failed = []
+    for filename, metadata in job_files:
+        # A list of files for the merges
+        filenames = filename if isinstance(filename, list) else [filename]
+        report("job", files=filenames)
+        try:
+            results.append(_process.process(_plan, filenames, metadata=metadata, keep=_keep))
+        except CancelledError:
+            # Stays unfinished in the journal
+            continue
+        except Exception as e:
+            job_failed(filenames, e)
+            failed.append(filename)
+            continue
+        journal = get_journal()
+        if journal is not None:
+            journal.done(filename)
+        report("done", files=filenames)
+    stats = get_stats()
+    return results, failed, None if stats is None else stats.drain(), get_reporter().drain()
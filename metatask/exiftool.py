@@ -0,0 +1,292 @@
+import json
+import time
+import queue
+import atexit
+import itertools
+import threading
+import subprocess
+import concurrent.futures
+import metatask
+
+
+EXIFTOOL = "/usr/bin/exiftool"
+BATCH_SIZE = 32
+# Maximum time to wait for other writes to send them together, in seconds
+WRITE_DELAY = 0.01
+
+
+class ExifToolError(Exception):
+    pass
+
+
+class ExifTool:
+    """
+    A long-lived `exiftool -stay_open True -@ -` process.
+
+    The arguments are sent on stdin, one per line, and each command is closed
+    by `-execute<number>`; exiftool answers with `{ready<number>}` on stdout,
+    and we ask it to echo the same marker on stderr to collect the errors.
+    """
+
+    def __init__(self, executable=None):
+        self.executable = executable or metatask.config.get("exiftool", EXIFTOOL)
+        self._process = None
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._process = subprocess.Popen(
+            [self.executable, "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+
+    def close(self):
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.write(b"-stay_open\nFalse\n")
+            self._process.stdin.flush()
+            self._process.stdin.close()
+            self._process.wait(timeout=5)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            self._process.kill()
+        self._process.stdout.close()
+        self._process.stderr.close()
+        self._process = None
+
+    def execute(self, *args):
+        """
+        Run one exiftool command, returns the stdout and the stderr.
+        """
+        return self.execute_many([args])[0]
+
+    def execute_many(self, commands):
+        """
+        Run many exiftool commands, they are all sent before reading the results,
+        returns a list of (stdout, stderr).
+        """
+        for args in commands:
+            for arg in args:
+                if "\n" in arg:
+                    raise ExifToolError(f"Unsupported new line in the exiftool argument '{arg}'")
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self.start()
+            readies = []
+            lines = []
+            for args in commands:
+                number = next(self._counter)
+                readies.append(f"{{ready{number}}}")
+                lines += list(args) + ["-echo4", readies[-1], f"-execute{number}"]
+            # The filenames that are not valid UTF-8 are sent as they are on the disk
+            self._process.stdin.write(("\n".join(lines) + "\n").encode("utf-8", errors="surrogateescape"))
+            self._process.stdin.flush()
+            return [
+                (self._read_until(self._process.stdout, ready), self._read_until(self._process.stderr, ready))
+                for ready in readies
+            ]
+
+    @staticmethod
+    def _read_until(stream, ready):
+        lines = []
+        while True:
+            line = stream.readline()
+            if line == b"":
+                raise ExifToolError("The exiftool process unexpectedly exits")
+            line = str(line, encoding="utf-8", errors="surrogateescape")
+            if line.rstrip("\r\n") == ready:
+                return "".join(lines)
+            lines.append(line)
+
+    def read(self, filenames, tags=None):
+        """
+        Read the metadata of the files, returns a dictionary filename => metadata,
+        the unreadable files are missing.
+        """
+        args = ["-json"]
+        if tags is not None:
+            args += [f"-{tag}" for tag in tags]
+        out, _ = self.execute(*args, *filenames)
+        results = {}
+        if out.strip() != "":
+            for metadata in json.loads(out):
+                results[metadata["SourceFile"]] = metadata
+        return results
+
+    def write(self, filename, tags):
+        """
+        Write the tags (dictionary tag => value) in the file.
+        """
+        error = self.write_many([(filename, tags)])[0]
+        if error is not None:
+            raise error
+
+    def write_many(self, writes):
+        """
+        Write the tags in many files, `writes` is a list of (filename, tags),
+        returns a list with None or the error for each file.
+        """
+        results = self.execute_many([
+            ["-overwrite_original"] + [f"-{tag!s}={value!s}" for tag, value in tags.items()] + [filename]
+            for filename, tags in writes
+        ])
+        # The file is unchanged when the tags already have the values
+        return [
+            None if "1 image files updated" in out or "1 image files unchanged" in out else
+            ExifToolError(f"Error on setting metadata on '{filename!s}': {err.strip()}")
+            for (filename, _), (out, err) in zip(writes, results)
+        ]
+
+
+class ExifToolPool:
+    """
+    A fixed set of `ExifTool` processes shared between the threads.
+    """
+
+    def __init__(self, size=None, executable=None):
+        if size is None:
+            size = metatask.config.get("nb_process", 8)
+        self._free = queue.Queue()
+        self._all = []
+        for _ in range(size):
+            exiftool = ExifTool(executable)
+            self._all.append(exiftool)
+            self._free.put(exiftool)
+
+    def _run(self, function, *args):
+        exiftool = self._free.get()
+        try:
+            return function(exiftool, *args)
+        finally:
+            self._free.put(exiftool)
+
+    def read(self, filenames, tags=None):
+        results = {}
+        for index in range(0, len(filenames), BATCH_SIZE):
+            results.update(self._run(ExifTool.read, filenames[index:index + BATCH_SIZE], tags))
+        return results
+
+    def write(self, filename, tags):
+        self._run(ExifTool.write, filename, tags)
+
+    def write_many(self, writes):
+        return self._run(ExifTool.write_many, writes)
+
+    def close(self):
+        for exiftool in self._all:
+            exiftool.close()
+
+
+class MetadataWriter:
+    """
+    Collect the metadata writes of the workers, and send them by batches to the exiftool pool.
+
+    A write waits at most `delay` for other writes, and a batch is sent to one exiftool process
+    as many commands sent together.
+    """
+
+    def __init__(self, pool, batch_size=BATCH_SIZE, delay=WRITE_DELAY, nb_batches=None):
+        if nb_batches is None:
+            nb_batches = metatask.config.get("nb_process", 8)
+        self.pool = pool
+        self.batch_size = batch_size
+        self.delay = delay
+        self._queue = queue.Queue()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=nb_batches)
+        self._thread = threading.Thread(target=self._collect, name="metatask-metadata-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, filename, tags):
+        """
+        Write the tags in the file, and wait for the result, raise an `ExifToolError` on error.
+        """
+        future = concurrent.futures.Future()
+        self._queue.put((filename, tags, future))
+        future.result()
+
+    def _collect(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            end = time.monotonic() + self.delay
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0, end - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            self._executor.submit(self._write, batch)
+
+    def _write(self, batch):
+        try:
+            errors = self.pool.write_many([(filename, tags) for filename, tags, _ in batch])
+        except Exception as e:
+            errors = [e] * len(batch)
+        for (_, _, future), error in zip(batch, errors):
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._executor.shutdown()
+
+
+_pool = None
+_writer = None
+_pool_lock = threading.Lock()
+
+
+def get_exiftool():
+    """
+    Get the shared exiftool pool, started on the first call.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ExifToolPool()
+            atexit.register(close_exiftool)
+        return _pool
+
+
+def get_metadata_writer():
+    """
+    Get the shared metadata writer, that uses the shared exiftool pool.
+    """
+    global _writer
+    pool = get_exiftool()
+    with _pool_lock:
+        if _writer is None:
+            _writer = MetadataWriter(pool)
+        return _writer
+
+
+def close_exiftool():
+    """
+    Stop the shared metadata writer and exiftool pool if they are started.
+    """
+    global _pool, _writer
+    with _pool_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def reset_exiftool():
+    """
+    Forget the exiftool pool of the parent without stopping it, in a forked worker process.
+    """
+    global _pool, _writer, _pool_lock
+    _pool = None
+    _writer = None
+    _pool_lock = threading.Lock()
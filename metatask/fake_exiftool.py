@@ -0,0 +1,99 @@
+"""
+An exiftool stand-in for the benchmarks, it supports the `-stay_open True -@ -` mode
+used by metatask, and returns synthetic metadata after a configurable latency.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+
+# Options without value that are not tags
+OPTIONS = {"json", "n", "overwrite_original", "stay_open", "@"}
+
+
+def metadata(filename):
+    stat = os.stat(filename)
+    return {
+        "SourceFile": filename,
+        "FileName": os.path.basename(filename),
+        "FileSize": stat.st_size,
+        "MIMEType": "image/jpeg",
+        "Make": "Metatask",
+        "Model": "Benchmark",
+        "DateTimeOriginal": time.strftime("%Y:%m:%d %H:%M:%S", time.localtime(stat.st_mtime)),
+        "ImageWidth": 4000,
+        "ImageHeight": 3000,
+        "ExposureTime": "1/250",
+        "FNumber": 2.8,
+    }
+
+
+def execute(args, options, out, err):
+    time.sleep(options.latency)
+    tags = set()
+    writes = []
+    filenames = []
+    for arg in args:
+        if arg.startswith("-"):
+            if "=" in arg:
+                writes.append(arg[1:].split("=", 1))
+            elif arg[1:] not in OPTIONS:
+                tags.add(arg[1:])
+        else:
+            filenames.append(arg)
+    results = []
+    nb_updated = 0
+    for filename in filenames:
+        time.sleep(options.file_latency)
+        if not os.path.isfile(filename):
+            err.write(f"Error: File not found - {filename}\n")
+            continue
+        if writes:
+            nb_updated += 1
+        else:
+            result = metadata(filename)
+            if tags:
+                result = {tag: value for tag, value in result.items() if tag in tags or tag == "SourceFile"}
+            results.append(result)
+    if writes:
+        out.write(f"    {nb_updated} image files updated\n")
+    elif results:
+        out.write(json.dumps(results) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0, help="latency of each command, in seconds")
+    parser.add_argument("--file-latency", type=float, default=0, help="latency of each file, in seconds")
+    options, args = parser.parse_known_args()
+
+    if args[:4] != ["-stay_open", "True", "-@", "-"]:
+        execute(args, options, sys.stdout, sys.stderr)
+        return
+    args = []
+    for line in sys.stdin:
+        line = line.rstrip("\n")
+        if line.startswith("-execute"):
+            echo = None
+            if "-echo4" in args:
+                index = args.index("-echo4")
+                echo = args[index + 1]
+                del args[index:index + 2]
+            execute(args, options, sys.stdout, sys.stderr)
+            sys.stdout.write(f"{{ready{line[len('-execute'):]}}}\n")
+            sys.stdout.flush()
+            if echo is not None:
+                sys.stderr.write(echo + "\n")
+            sys.stderr.flush()
+            args = []
+        elif line == "False" and args[-1:] == ["-stay_open"]:
+            return
+        else:
+            args.append(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import pickle
+import sqlite3
+import metatask
+from metatask.utils import LazyMetadata
+
+
+# Number of jobs with metadata kept in memory, the metadata of the next ones are spilled
+SPILL_THRESHOLD = 10000
+# Number of spilled metadata written together
+SPILL_BATCH = 1000
+
+
+class _Missing:
+    """
+    A tag that is not in the metadata, pickled by reference.
+    """
+
+    def __reduce__(self):
+        return "MISSING"
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = _Missing()
+# In memory marker of the spilled metadata
+_SPILLED = object()
+
+
+class JobList:
+    """
+    The planned jobs (filename, metadata), kept compact until they are run.
+
+    The filenames and the metadata are stored in two columns. When the metadata are read with
+    the `tags` of the plan, only the values of those tags are kept, in a tuple, and the metadata
+    are rebuilt as `LazyMetadata` when the jobs are iterated. Above `spill_threshold` jobs with
+    metadata, the metadata of the next ones are pickled in a temporary SQLite database.
+    """
+
+    def __init__(self, tags=None, spill_threshold=None):
+        if spill_threshold is None:
+            spill_threshold = metatask.config.get("job_spill_threshold", SPILL_THRESHOLD)
+        self.tags = None if tags is None else tuple(tags)
+        self.spill_threshold = spill_threshold
+        self._filenames = []
+        self._metadata = []
+        self._nb_in_memory = 0
+        self._spilled = []
+        self._connection = None
+
+    def __len__(self):
+        return len(self._filenames)
+
+    def _compact(self, metadata):
+        if self.tags is None or not isinstance(metadata, LazyMetadata):
+            return metadata
+        # Without reading the missing tags
+        return tuple(dict.get(metadata, tag, MISSING) for tag in self.tags)
+
+    def _expand(self, filename, metadata):
+        if not isinstance(metadata, tuple):
+            return metadata
+        # The metadata of a merge are the ones of the first file
+        first = filename[0] if isinstance(filename, list) else filename
+        return LazyMetadata(first, {
+            tag: value for tag, value in zip(self.tags, metadata) if value is not MISSING
+        }, absent=[tag for tag, value in zip(self.tags, metadata) if value is MISSING])
+
+    def append(self, job):
+        filename, metadata = job
+        metadata = self._compact(metadata)
+        if metadata is not None:
+            if self._nb_in_memory >= self.spill_threshold:
+                self._spilled.append((len(self._filenames), pickle.dumps(metadata, pickle.HIGHEST_PROTOCOL)))
+                if len(self._spilled) >= SPILL_BATCH:
+                    self._flush()
+                metadata = _SPILLED
+            else:
+                self._nb_in_memory += 1
+        self._filenames.append(filename)
+        self._metadata.append(metadata)
+
+    def extend(self, jobs):
+        for job in jobs:
+            self.append(job)
+
+    def _flush(self):
+        if self._connection is None:
+            # A private temporary database, removed when it's closed
+            self._connection = sqlite3.connect("", check_same_thread=False)
+            self._connection.execute("CREATE TABLE metadata (no INTEGER PRIMARY KEY, data BLOB)")
+        with self._connection:
+            self._connection.executemany("INSERT INTO metadata VALUES (?, ?)", self._spilled)
+        self._spilled = []
+
+    def __iter__(self):
+        if self._spilled:
+            self._flush()
+        spilled = iter(()) if self._connection is None else \
+            self._connection.execute("SELECT data FROM metadata ORDER BY no")
+        for filename, metadata in zip(self._filenames, self._metadata):
+            if metadata is _SPILLED:
+                metadata = pickle.loads(next(spilled)[0])
+            yield filename, self._expand(filename, metadata)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,287 @@
+import os
+import glob
+import json
+import time
+import datetime
+import threading
+import metatask
+from metatask.cache import CACHE_PATH
+from metatask.utils import fcntl
+
+
+JOURNAL_PATH = os.path.join(os.path.dirname(CACHE_PATH), "journal.jsonl")
+# Number of records or seconds between two syncs on the disk
+SYNC_INTERVAL = 1000
+SYNC_DELAY = 1
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {"$datetime": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode(value):
+    if len(value) == 1 and "$datetime" in value:
+        return datetime.datetime.fromisoformat(value["$datetime"])
+    return value
+
+
+def job_key(filenames):
+    """
+    The key of a job, from its file or its list of files.
+    """
+    return tuple(filenames) if isinstance(filenames, list) else (filenames,)
+
+
+class Journal:
+    """
+    Append only journal of an apply run: the plan, the planned jobs, the temporary files,
+    the moves and the finished jobs.
+
+    Each record is a JSON line written with one `write` on a file opened in append mode,
+    so the worker processes can write in the same journal. The records are synced on the
+    disk by batches of `SYNC_INTERVAL` records or every `SYNC_DELAY` seconds.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._nb_unsynced = 0
+        self._last_sync = time.monotonic()
+        self.nb_jobs = 0
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    def write(self, record):
+        line = (json.dumps(record, default=_encode) + "\n").encode("utf-8")
+        with self._lock:
+            if self._fd is None:
+                return
+            os.write(self._fd, line)
+            self._nb_unsynced += 1
+            if self._nb_unsynced >= SYNC_INTERVAL or time.monotonic() - self._last_sync > SYNC_DELAY:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._fd)
+        self._nb_unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def sync(self):
+        with self._lock:
+            if self._fd is not None and self._nb_unsynced != 0:
+                self._sync()
+
+    def job(self, filenames, metadata):
+        self.nb_jobs += 1
+        self.write({"type": "job", "files": filenames, "metadata": metadata})
+
+    def jobs(self, job_files):
+        """
+        Record the jobs while they are yielded, e.g. when they are planned while they are run.
+        """
+        for filenames, metadata in job_files:
+            self.job(filenames, metadata)
+            yield filenames, metadata
+
+    def temp(self, filename):
+        self.write({"type": "temp", "path": os.path.abspath(filename)})
+
+    def move(self, filenames, destination):
+        self.write({"type": "move", "files": filenames, "destination": destination})
+
+    def done(self, filenames):
+        self.write({"type": "done", "files": filenames})
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+
+
+def read_journal(path):
+    """
+    Read the journal of an interrupted run, returns the plan record, the unfinished jobs
+    (filenames, metadata) in the planned order, and the temporary files that still exist.
+    """
+    plan = None
+    jobs = {}
+    finished = set()
+    temps = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line, object_hook=_decode)
+            except ValueError:
+                # The last record can be partial
+                continue
+            type_ = record.get("type")
+            if type_ == "plan":
+                plan = record
+            elif type_ == "job":
+                jobs[job_key(record["files"])] = (record["files"], record["metadata"])
+            elif type_ in ("move", "done"):
+                finished.add(job_key(record["files"]))
+            elif type_ == "temp":
+                temps.append(record["path"])
+    if plan is None:
+        raise Exception(f"The journal '{path}' has no plan")
+    unfinished = [job for key, job in jobs.items() if key not in finished]
+    return plan, unfinished, [temp for temp in temps if os.path.exists(temp)]
+
+
+_journal = None
+_journal_lock = threading.Lock()
+# The journal of the interrupted run that is resumed, (path, locked file descriptor)
+_resumed = None
+
+
+def journal_path():
+    """
+    The base path of the journals, each run has its journal `<base>-<date>-<pid>.jsonl`.
+    """
+    return metatask.config.get("journal_path", JOURNAL_PATH)
+
+
+def _lock(fd, blocking=True):
+    """
+    Lock the journal for the lifetime of its run, returns False if it's already locked.
+    """
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def _claim(path):
+    """
+    Open and lock the journal of an interrupted run, None if its run is still running.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    if not _lock(fd, blocking=False):
+        os.close(fd)
+        return None
+    return fd
+
+
+def interrupted_journals():
+    """
+    Get the journals of the interrupted runs, the oldest first, the ones of the running applies
+    are locked and skipped.
+    """
+    root, ext = os.path.splitext(journal_path())
+    interrupted = []
+    for path in sorted(glob.glob(glob.escape(root) + "-*" + glob.escape(ext))):
+        fd = _claim(path)
+        if fd is not None:
+            os.close(fd)
+            interrupted.append(path)
+    return interrupted
+
+
+def discard_journals():
+    """
+    Remove the journals of the interrupted runs, they can't be resumed anymore.
+    """
+    for path in interrupted_journals():
+        fd = _claim(path)
+        if fd is not None:
+            os.unlink(path)
+            os.close(fd)
+
+
+def resume_journal():
+    """
+    Claim the journal of the last interrupted run to resume it, it's removed when the journal
+    of the resumed run is started. None if there is no interrupted run.
+    """
+    global _resumed
+    for path in reversed(interrupted_journals()):
+        fd = _claim(path)
+        if fd is not None:
+            _resumed = (path, fd)
+            return path
+    return None
+
+
+def release_resumed(remove=False):
+    """
+    Release the journal of the resumed run, e.g. when nothing is run, and remove it if `remove`.
+    """
+    global _resumed
+    if _resumed is not None:
+        path, fd = _resumed
+        if remove:
+            os.unlink(path)
+        os.close(fd)
+        _resumed = None
+
+
+def get_journal():
+    """
+    Get the journal of the running apply, None if there is no one.
+    """
+    return _journal
+
+
+def start_journal(names, keep, job_files=(), stream=False):
+    """
+    Start the journal of an apply run with the plan and the planned jobs, it's locked until
+    the end of the run, and it replaces the journal of the resumed run when it's complete.
+    None if the journal is disabled.
+    """
+    global _journal
+    if metatask.config.get("journal", True) is not True:
+        return None
+    root, ext = os.path.splitext(journal_path())
+    path = f"{root}-{datetime.datetime.now():%Y%m%d%H%M%S}-{os.getpid()}{ext}"
+    directory = os.path.dirname(path)
+    if directory != '' and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    new_path = path + ".new"
+    journal = Journal(new_path)
+    _lock(journal._fd)
+    journal.write({"type": "plan", "names": names, "keep": keep, "stream": stream})
+    for filenames, metadata in job_files:
+        journal.job(filenames, metadata)
+    journal.sync()
+    os.replace(new_path, path)
+    journal.path = path
+    release_resumed(remove=True)
+    with _journal_lock:
+        _journal = journal
+    return journal
+
+
+def open_journal(path):
+    """
+    Open the journal of the running apply, e.g. in a worker process.
+    """
+    global _journal
+    with _journal_lock:
+        if _journal is not None:
+            _journal.close()
+        _journal = None if path is None else Journal(path)
+
+
+def close_journal(finished=False):
+    """
+    Sync and close the journal, it's removed if the run is finished.
+    """
+    global _journal
+    with _journal_lock:
+        if _journal is not None:
+            # Removed before it's unlocked
+            if finished:
+                os.unlink(_journal.path)
+            _journal.close()
+            _journal = None
+    release_resumed()
@@ -0,0 +1,374 @@
+import re
+import copy
+import json
+import string
+import hashlib
+import functools
+import threading
+import collections
+import metatask
+import bashcolor
+from metatask.stats import measure
+
+
+JINJA_GLOBALS = {"len", "str", "format_num_on_demon", "m"}
+FORMAT_PARAMS = {"in", "out"}
+# The attributes of `m` that are not tags: the dict methods (e.g. `m.get(...)`, `m.items()`)
+# and the attributes of `LazyMetadata`
+M_ATTRIBUTES = set(dir(dict)) | {"filename", "read_types", "absent"}
+EXTENSION_RE = re.compile(r"\.[a-z0-9A-Z]{2,5}$")
+# Maximum number of compiled Jinja templates kept
+TEMPLATE_CACHE_SIZE = 256
+
+
+def format_num_on_demon(fract):
+    if fract is None:
+        return ''
+    if fract == '':
+        return ''
+    if isinstance(fract, int):
+        return f"{fract:02d}"
+    if isinstance(fract, dict):
+        print(fract)
+    s = fract.split("/")
+    if len(s) == 1:
+        return f"{int(s[0]):02d}"
+    elif len(s) == 2:
+        n, d = s
+        return ("%0" + str(len(d)) + "d") % int(n)
+    else:
+        return fract
+
+
+def format_filename(destination_filename, from_re, to_re, do_metadata=False, metadata=None, template=None):
+    """
+    Replace `from_re` by `to_re` in the filename, `to_re` can use the metadata.
+
+    `from_re` can be a compiled regular expression and `template` a compiled Jinja template.
+    """
+    if do_metadata is True:
+        if template == 'jinja':
+            template = compile_template(to_re)
+        if template is not None:
+            to_re = render(template, metadata)
+        else:
+            to_re = to_re.format_map(metadata)
+
+    return re.sub(from_re, to_re, destination_filename)
+
+
+_environment = None
+_environment_lock = threading.Lock()
+
+
+def get_environment():
+    """
+    Get the shared Jinja environment, with the helpers as globals.
+    """
+    global _environment
+    if _environment is None:
+        with _environment_lock:
+            if _environment is None:
+                # Jinja is slow to import, only when a template is used
+                import jinja2
+                environment = jinja2.Environment(auto_reload=False)
+                environment.globals.update(len=len, str=str, format_num_on_demon=format_num_on_demon)
+                _environment = environment
+    return _environment
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(source):
+    """
+    Compile the Jinja template, the last used templates are kept by source.
+    """
+    return get_environment().from_string(source)
+
+
+def render(template, metadata):
+    """
+    Render the template with the metadata as variables and as `m`,
+    the metadata are looked up in place, without being copied in the context.
+    """
+    context = template.new_context(
+        collections.ChainMap({"m": metadata}, metadata, template.globals), shared=True
+    )
+    try:
+        return "".join(template.root_render_func(context))
+    except Exception:
+        return template.environment.handle_exception()
+
+
+def precompile_templates(cmds):
+    """
+    Compile the Jinja templates of the commands, to get the syntax errors early.
+    """
+    for cmd in cmds.values():
+        for step in cmd.get("do", [cmd]) if cmd.get("type") == "rename" else []:
+            if step.get("metadata", False) is True and step.get("template") == "jinja":
+                compile_template(step["to"])
+
+
+def replace_extension(filename, extension):
+    return "{!s}.{!s}".format(EXTENSION_RE.sub("", filename), extension)
+
+
+def _format_tags(format_):
+    tags = set()
+    for _, field_name, _, _ in string.Formatter().parse(format_):
+        if field_name:
+            tag = re.split(r"[.\[]", field_name, maxsplit=1)[0]
+            if tag != '' and not tag.isdigit() and tag not in FORMAT_PARAMS:
+                tags.add(tag)
+    return tags
+
+
+def _jinja_tags(template):
+    import jinja2.meta
+    import jinja2.nodes
+    ast = get_environment().parse(template)
+    tags = jinja2.meta.find_undeclared_variables(ast) - JINJA_GLOBALS
+    nb_m_access = 0
+    for node in ast.find_all(jinja2.nodes.Call):
+        if isinstance(node.node, (jinja2.nodes.Getattr, jinja2.nodes.Getitem)) and \
+                isinstance(node.node.node, jinja2.nodes.Name) and node.node.node.name == "m":
+            # A call on `m`, used as a whole
+            return None
+    for node in ast.find_all((jinja2.nodes.Getattr, jinja2.nodes.Getitem)):
+        if isinstance(node.node, jinja2.nodes.Name) and node.node.name == "m":
+            if isinstance(node, jinja2.nodes.Getattr):
+                if node.attr in M_ATTRIBUTES:
+                    return None
+                tags.add(node.attr)
+            elif isinstance(node.arg, jinja2.nodes.Const):
+                tags.add(str(node.arg.value))
+            else:
+                return None
+            nb_m_access += 1
+    if nb_m_access != len([node for node in ast.find_all(jinja2.nodes.Name) if node.name == "m"]):
+        # `m` is used as a whole
+        return None
+    return tags
+
+
+def referenced_tags(cmds):
+    """
+    Get the metadata tags used by the commands, None if we need all of them.
+    """
+    tags = set()
+    for cmd in cmds:
+        for step in cmd.get("do", [cmd]) if cmd.get("type") == "rename" else [cmd]:
+            if step.get("metadata", False) is True and step.get("to") is not None:
+                if step.get("template") == "jinja":
+                    template_tags = _jinja_tags(step["to"])
+                    if template_tags is None:
+                        return None
+                    tags |= template_tags
+                else:
+                    tags |= _format_tags(step["to"])
+        if cmd.get("cmd") is not None:
+            tags |= _format_tags(cmd["cmd"])
+    return sorted(tags)
+
+
+class RenameStep:
+    """
+    A compiled rename: `from` regexp, `to` pattern or Jinja template, or `format`.
+    """
+
+    def __init__(self, config):
+        self.from_re = re.compile(config.get('from', '.*'))
+        self.to = config.get('to')
+        self.format = config.get('format')
+        self.metadata = config.get('metadata', False) is True
+        self.jinja = self.metadata and config.get('template') == 'jinja'
+        self.template = compile_template(self.to) if self.jinja else None
+        if self.format is not None:
+            self.kind = "case"
+        elif self.jinja:
+            self.kind = "jinja"
+        else:
+            self.kind = "metadata" if self.metadata else "regex"
+
+    def __getstate__(self):
+        # The compiled Jinja templates can't be pickled
+        state = dict(self.__dict__)
+        state["template"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.jinja:
+            self.template = compile_template(self.to)
+
+    def apply(self, filename, metadata):
+        with measure(f"format.{self.kind}"):
+            if self.format == 'upper':
+                return self.from_re.sub(lambda m: m.group(0).upper(), filename)
+            if self.format == 'lower':
+                return self.from_re.sub(lambda m: m.group(0).lower(), filename)
+            return format_filename(filename, self.from_re, self.to, self.metadata, metadata, self.template)
+
+
+class Command:
+    """
+    A command of the configuration, resolved and compiled.
+    """
+
+    def __init__(self, config, name=None):
+        self.config = config
+        self.name = name if name is not None else config.get("name", "")
+        self.type = config.get("type", "cmd")
+        self.display = config.get("display", "")
+        self.metadata = config.get("metadata", False) is True
+        self.cmd = config.get("cmd")
+        self.out_ext = config.get("out_ext")
+        self.inplace = config.get("inplace", False)
+        self.timeout = config.get("timeout")
+        self.resources = config.get("resources")
+        self.shell = config.get("shell")
+        self.stream = config.get("stream", False) is True
+        self.steps = []
+        if self.type == "rename":
+            self.steps = [RenameStep(do) for do in config.get("do", [config])]
+        elif self.type == "metadata":
+            self.tag = config.get("tag")
+            self.value_get = re.compile("^.*{}.*$".format(config.get("value_get")))
+            self.value_format = config.get("value_format")
+            # The metadata commands written together
+            self.writes = [self]
+
+    def rename(self, filename, metadata):
+        for step in self.steps:
+            filename = step.apply(filename, metadata)
+        return filename
+
+    def value(self, filename):
+        """
+        The value of the metadata to set, for the `metadata` type.
+        """
+        return self.value_get.sub(self.value_format, filename)
+
+    def values(self, filename):
+        """
+        The tags to set, for the `metadata` type.
+        """
+        return {cmd.tag: cmd.value(filename) for cmd in self.writes}
+
+
+def pipeline(cmds):
+    """
+    Join consecutive streaming commands (that read stdin and write stdout) in one shell pipeline.
+    """
+    resources = {}
+    for cmd in cmds:
+        for name, weight in (cmd.resources or {"cpu": 1}).items():
+            resources[name] = resources.get(name, 0) + weight
+    timeouts = [cmd.timeout for cmd in cmds]
+    out_ext = None
+    for cmd in cmds:
+        if cmd.out_ext is not None:
+            out_ext = cmd.out_ext
+    return Command({
+        "name": " | ".join(cmd.name for cmd in cmds),
+        "cmd": "cat {in} | " + " | ".join(f"({cmd.cmd})" for cmd in cmds) + " > {out}",
+        "out_ext": out_ext,
+        "resources": resources,
+        "timeout": None if None in timeouts else sum(timeouts),
+        # Fails if any of the commands fails
+        "shell": ["bash", "-o", "pipefail"],
+    })
+
+
+def metadata_group(cmds):
+    """
+    Join consecutive metadata commands, to write all the tags at once.
+    """
+    if len(cmds) == 1:
+        return cmds[0]
+    group = copy.copy(cmds[0])
+    group.name = " + ".join(cmd.name for cmd in cmds)
+    group.writes = cmds
+    return group
+
+
+class CommandPlan:
+    """
+    The commands to apply on the files, resolved against the configuration and compiled once,
+    then used read-only by all the workers.
+
+    `steps` are the commands to run, where the consecutive streaming commands are joined,
+    and the consecutive metadata commands are grouped.
+
+    A plan can be pickled to be sent to the worker processes.
+    """
+
+    def __init__(self, names, cmds_config=None):
+        if cmds_config is None:
+            cmds_config = metatask.config.get("cmds", {})
+        self.commands = []
+        for cmd in names:
+            if isinstance(cmd, str):
+                config = cmds_config.get(cmd)
+                if config is None:
+                    raise Exception(f"Missing command '{cmd!s}' in `cmds`")
+                self.commands.append(Command(config, cmd))
+            else:
+                self.commands.append(Command(cmd))
+        self.types = frozenset(cmd.type for cmd in self.commands)
+        self.need_metadata = any(cmd.metadata for cmd in self.commands)
+        self.tags = referenced_tags([cmd.config for cmd in self.commands])
+        # Identify the plan in the incremental state
+        self.digest = hashlib.blake2b(json.dumps(
+            [[cmd.name, cmd.config] for cmd in self.commands], sort_keys=True, default=str
+        ).encode(), digest_size=16).hexdigest()
+        self.out_ext = None
+        for cmd in self.commands:
+            if cmd.type != "metadata" and cmd.out_ext is not None:
+                self.out_ext = cmd.out_ext
+        self.steps = []
+        for cmd in self.commands:
+            previous = self.steps[-1] if self.steps else None
+            if isinstance(previous, list) and (
+                cmd.stream and previous[0].stream or cmd.type == "metadata" == previous[0].type
+            ):
+                previous.append(cmd)
+            else:
+                self.steps.append([cmd] if cmd.stream or cmd.type == "metadata" else cmd)
+        self.steps = [
+            step if not isinstance(step, list) else pipeline(step) if step[0].stream else metadata_group(step)
+            for step in self.steps
+        ]
+
+    @staticmethod
+    def get(names):
+        """
+        Get a plan from a plan or from a list of command names or configurations.
+        """
+        if isinstance(names, CommandPlan):
+            return names
+        return CommandPlan(names)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    def destination_filename(self, filename, extension=None, metadata=None):
+        messages = []
+
+        for cmd in self.commands:
+            if cmd.type == 'rename':
+                filename = cmd.rename(filename, metadata)
+            if cmd.type == "metadata":
+                messages.append("Set the metadata '{!s}' to '{!s}'.".format(
+                    bashcolor.colorize(cmd.name, bashcolor.BLUE),
+                    bashcolor.colorize(cmd.value(filename), bashcolor.GREEN)
+                ))
+
+        if self.out_ext is not None:
+            extension = self.out_ext
+        if extension is not None:
+            filename = replace_extension(filename, extension)
+        return filename, extension, set(self.types), messages
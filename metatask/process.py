@@ -1,153 +1,227 @@
 import os
-import re
-import shutil
-import threading
-import metatask
-import jinja2
-import subprocess
-import bashcolor
-from tempfile import NamedTemporaryFile
-from PyQt5.QtCore import QObject, pyqtSignal
-
-
-def format_num_on_demon(fract):
-    if fract is None:
-        return ''
-    if fract == '':
-        return ''
-    if isinstance(fract, int):
-        return f"{fract:02d}"
-    if isinstance(fract, dict):
-        print(fract)
-    s = fract.split("/")
-    if len(s) == 1:
-        return f"{int(s[0]):02d}"
-    elif len(s) == 2:
-        n, d = s
-        return ("%0" + str(len(d)) + "d") % int(n)
-    else:
-        return fract
-
-
-class Process(QObject):
-    progress = pyqtSignal(int, str, str, dict)
+import collections
+from metatask.exiftool import get_metadata_writer
+from metatask.cache import get_cache
+from metatask.state import get_state
+from metatask.journal import get_journal
+from metatask.plan import CommandPlan, RenameStep, format_filename, replace_extension, \
+    format_num_on_demon  # noqa: F401
+from metatask.tempfiles import temp_filename, clone_file, link_or_clone, claim_destination, move_file
+from metatask.utils import StripedLock
+from metatask.stats import measure, locked
+from metatask.events import report
+from concurrent.futures import CancelledError
+
+
+def get_runner():
+    # asyncio is slow to import, only when a shell command is run
+    from metatask.runner import get_runner
+    return get_runner()
+
+
+def _next_command(steps, error=None):
+    """
+    Resume the steps of a job, returns (True, result) when it's finished, else (False, command).
+    """
+    try:
+        return False, steps.send(None) if error is None else steps.throw(error)
+    except StopIteration as stop:
+        return True, stop.value
+
+
+class Process:
+    """
+    Apply the commands on the files.
+
+    `progress` is called with the number, the name, the command line and the configuration
+    of each shell command before it's run, see `metatask.qt.QtProgress` for a Qt signal.
+    """
+
+    # Set by `stop`
     cancel = False
-    lock = threading.Lock()
+    # By destination, the destinations are claimed atomically, and the copies are done without lock
+    locks = StripedLock()
+
+    def __init__(self, progress=None):
+        self.progress = progress
+
+    @classmethod
+    def stop(cls):
+        """
+        Cancel the processing: kill the running commands and cancel the waiting ones.
+        """
+        cls.cancel = True
+        get_runner().cancel()
 
     def process(
             self, names, filenames=None, destination_filename=None,
             in_extention=None, get_content=False, metadata=None, keep=False):
+        with measure("process"):
+            steps = self._steps(
+                names, filenames, destination_filename, in_extention, get_content, metadata, keep
+            )
+            error = None
+            while True:
+                finished, value = _next_command(steps, error)
+                if finished:
+                    return value
+                error = None
+                try:
+                    get_runner().run(*value)
+                except BaseException as e:
+                    error = e
+
+    async def process_async(
+            self, executor, names, filenames=None, destination_filename=None,
+            in_extention=None, get_content=False, metadata=None, keep=False):
+        """
+        Like `process` but in the event loop of the runner, the Python parts of the job are run
+        in the `executor` threads, and no thread waits while the shell commands run.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        runner = get_runner()
+        with measure("process"):
+            steps = self._steps(
+                names, filenames, destination_filename, in_extention, get_content, metadata, keep
+            )
+            error = None
+            while True:
+                finished, value = await loop.run_in_executor(executor, _next_command, steps, error)
+                if finished:
+                    return value
+                error = None
+                try:
+                    await runner.run_async(*value)
+                except asyncio.CancelledError:
+                    error = CancelledError()
+                except Exception as e:
+                    error = e
+
+    def _steps(self, names, filenames, destination_filename, in_extention, get_content, metadata, keep):
+        """
+        Process the files, the shell commands to run are yielded as the arguments of
+        `CommandRunner.run`, and their errors are thrown in.
+        """
         is_merged = False
         out_ext = in_extention
-        cmds_config = metatask.config.get("cmds", {})
-        cmds = []
-        for cmd in names:
-            if isinstance(cmd, str):
-                c = cmds_config.get(cmd)
-                if c is None:
-                    raise Exception(f"Missing command '{cmd!s}' in `cmds`")
-                c["name"] = cmd
-                cmds.append(c)
-            else:
-                cmds.append(cmd)
+        plan = CommandPlan.get(names)
 
         filename = filenames[0] if isinstance(filenames, list) else filenames
         if destination_filename is None:
             destination_filename = filename
 
         if filename is not None:
-            dst, _, types, _ = self.destination_filename(names, filename, metadata=metadata)
+            dst, _, types, _ = plan.destination_filename(filename, metadata=metadata)
             if types == set():
                 return None, None
             if types == {"rename"}:
                 if filename != dst:
                     directory = os.path.dirname(dst)
-                    with self.lock:
-                        if directory != '' and not os.path.exists(directory):
-                            os.makedirs(directory)
-                        if not os.path.exists(dst):
-                            shutil.move(filename, dst)
+                    if directory != '':
+                        os.makedirs(directory, exist_ok=True)
+                    try:
+                        with locked(self.locks.get(dst)):
+                            linked = claim_destination(filename, dst)
+                    except FileExistsError:
+                        return None, None
+                    self._move(filename, dst, linked)
+                    self._journal_move(filenames, dst)
+                    cache = get_cache()
+                    if cache is not None:
+                        cache.rename(filename, dst)
+                    return dst, None
+                return None, None
+
+        # Incremental mode, for the transformations of one file
+        state = None
+        is_merge = isinstance(filenames, list) and len(filenames) > 1
+        if filename is not None and not get_content and not is_merge:
+            state = get_state()
+            if state is not None and state.up_to_date(filename, plan):
                 return None, None
 
+        # The temporary files are created next to the destination, to be moved without copy
+        temp_directory = None
+        if not get_content:
+            temp_directory = os.path.dirname(dst if filename is not None else destination_filename)
+            if temp_directory != '':
+                os.makedirs(temp_directory, exist_ok=True)
+
         original_filename = filename
-        if cmds[0].get("inplace") is True or cmds[0].get("type" == "metadata"):
-            if in_extention is None:
-                out_name = NamedTemporaryFile(mode='w+b').name
+        steps = [cmd for cmd in plan.steps if cmd.type != "rename"]
+        if steps and (steps[0].inplace is True or steps[0].type == "metadata"):
+            out_name = self._temp_filename(temp_directory, in_extention)
+            # exiftool replaces the file, then a hard link is enough until an inplace command
+            replaced = next((cmd for cmd in steps if cmd.type != "metadata"), None)
+            if replaced is None or replaced.inplace is not True:
+                link_or_clone(filename, out_name)
             else:
-                out_name = NamedTemporaryFile(
-                    mode='w+b',
-                    suffix='.' + in_extention
-                ).name
-            shutil.copyfile(filename, out_name)
+                clone_file(filename, out_name)
             filename = out_name
 
-        for no, cmd in enumerate(cmds):
-            if isinstance(cmd, str):
-                cmd = dict(cmd=cmd)
-
-            if cmd.get('type') == 'rename':
-                destination_filename = self._rename(cmd, destination_filename, metadata)
-            if cmd.get("type") == "metadata":
-                value = cmd.get('value_format')
-                value = self._format(
-                    filename,
-                    cmd.get("value_get"),
-                    cmd.get("value_format"),
-                )
-                subprocess.check_output(['exiftool', '-{!s}={!s}'.format(cmd.get('tag'), value), filename])
-            else:
-                if 'out_ext' in cmd:
-                    out_ext = cmd['out_ext']
+        out_name = filename
+        try:
+            for no, cmd in enumerate(plan.steps):
+                if cmd.type == 'rename':
+                    destination_filename = cmd.rename(destination_filename, metadata)
+                elif cmd.type == "metadata":
+                    tags = cmd.values(destination_filename)
+                    report("metadata", name=cmd.name, tags=tags, file=destination_filename)
+                    # An error fails the job
+                    with measure(f"metadata.{cmd.name}"):
+                        get_metadata_writer().write(filename, tags)
+                else:
+                    if cmd.out_ext is not None:
+                        out_ext = cmd.out_ext
 
-                inplace = cmd.get('inplace', False)
-                cmd_cmd = cmd.get('cmd')
+                    inplace = cmd.inplace
+                    cmd_cmd = cmd.cmd
 
-                if inplace:
-                    out_name = filename
-                else:
-                    if out_ext is None:
-                        out_name = NamedTemporaryFile(mode='w+b').name
+                    if inplace:
+                        out_name = filename
                     else:
-                        out_name = NamedTemporaryFile(
-                            mode='w+b',
-                            suffix='.' + out_ext
-                        ).name
-
-                params = {}
-                if metadata is not None:
-                    params.update(metadata)
-
-                # it's a merge
-                if not is_merged and isinstance(filenames, list):
-                    params["in"] = " ".join([
-                        "'{!s}'".format(f.replace("'", "'\"'\"'")) for f in filenames
-                    ])
-                    # do the merge only one time
-                    is_merged = True
-                elif filename is not None:
-                    params["in"] = "'{!s}'".format(filename.replace("'", "'\"'\"'"))
-
-                if not inplace:
-                    params["out"] = "'{!s}'".format(out_name.replace("'", "'\"'\"'"))
+                        out_name = self._temp_filename(temp_directory, out_ext)
 
-                try:
-                    cmd_cmd = cmd_cmd.format(**params)
-                except Exception:
-                    print("Error in {name}: {cmd}, with {params}".format(
-                        name=cmd["name"], cmd=cmd_cmd, params=params))
-                    raise
-
-                self.progress.emit(no, cmd["name"], cmd_cmd, cmd)
-                if self.cancel is True:
-                    return None, None
-                print("{name}: {cmd}".format(
-                    name=bashcolor.colorize(cmd["name"], bashcolor.BLUE), cmd=cmd_cmd
-                ))
-                subprocess.check_call(cmd_cmd, shell=True)
-
-                if filename != original_filename and not inplace:
-                    os.unlink(filename)
-                filename = out_name
+                    params = {}
+
+                    # it's a merge
+                    if not is_merged and isinstance(filenames, list) and len(filenames) > 1:
+                        params["in"] = " ".join([
+                            "'{!s}'".format(f.replace("'", "'\"'\"'")) for f in filenames
+                        ])
+                        # do the merge only one time
+                        is_merged = True
+                    elif filename is not None:
+                        params["in"] = "'{!s}'".format(filename.replace("'", "'\"'\"'"))
+
+                    if not inplace:
+                        params["out"] = "'{!s}'".format(out_name.replace("'", "'\"'\"'"))
+
+                    try:
+                        cmd_cmd = cmd_cmd.format_map(
+                            params if metadata is None else collections.ChainMap(params, metadata)
+                        )
+                    except Exception:
+                        report("error", message="Error in {name}: {cmd}, with {params}".format(
+                            name=cmd.name, cmd=cmd_cmd, params=params), file=destination_filename)
+                        raise
+
+                    if self.progress is not None:
+                        self.progress(no, cmd.name, cmd_cmd, cmd.config)
+                    if self.cancel is True:
+                        raise CancelledError()
+                    report("command", no=no, name=cmd.name, cmd=cmd_cmd, file=destination_filename)
+                    with measure(f"command.{cmd.name}"):
+                        yield cmd_cmd, cmd.timeout, cmd.resources, cmd.shell
+
+                    if filename != original_filename and not inplace:
+                        os.unlink(filename)
+                    filename = out_name
+        except BaseException:
+            # e.g. a failed command or metadata write, a timeout or a cancellation
+            self._remove_temp_files(original_filename, filename, out_name)
+            raise
 
         if get_content:
             content = None
@@ -159,116 +233,83 @@ class Process(QObject):
             return content, out_ext
         else:
             if out_ext is not None:
-                destination_filename = "{!s}.{!s}".format(re.sub(
-                    r"\.[a-z0-9A-Z]{2,5}$", "",
-                    destination_filename
-                ), out_ext)
+                destination_filename = replace_extension(destination_filename, out_ext)
+            moved = False
             if filename != destination_filename:
                 directory = os.path.dirname(destination_filename)
-                with self.lock:
-                    if directory != "" and not os.path.exists(directory):
-                        os.makedirs(directory)
-                    if filename != destination_filename and (
-                            # apply on new file
-                            filenames is None or
-                            # apply a transformation on the file
-                            len(filenames) == 1 and filenames[0] == destination_filename or
-                            not os.path.exists(destination_filename)
-                    ):
-                        print("{name}: {file}".format(
-                            name=bashcolor.colorize('copy', bashcolor.BLUE),
-                            file=bashcolor.colorize(destination_filename, bashcolor.YELLOW),
-                        ))
-                        shutil.move(filename, destination_filename)
-                        if not keep and original_filename != destination_filename:
-                            if isinstance(filenames, list):
-                                for f in filenames:
-                                    if f != filename:
-                                        os.unlink(f)
-                            elif original_filename is not None and original_filename != filename:
-                                os.unlink(original_filename)
+                if directory != "":
+                    os.makedirs(directory, exist_ok=True)
+                # apply on new file, or apply a transformation on the file
+                replace = filenames is None or len(filenames) == 1 and filenames[0] == destination_filename
+                # The previous output of the file in incremental mode
+                replace = replace or state is not None and \
+                    state.is_output(original_filename, destination_filename)
+                linked = False
+                try:
+                    if not replace:
+                        with locked(self.locks.get(destination_filename)):
+                            linked = claim_destination(filename, destination_filename)
+                    moved = True
+                except FileExistsError:
+                    pass
+                if moved:
+                    report("copy", destination=destination_filename)
+                    self._move(filename, destination_filename, linked, placeholder=not replace)
+                    self._journal_move(filenames, destination_filename)
+                    if not keep and original_filename != destination_filename:
+                        if isinstance(filenames, list):
+                            for f in filenames:
+                                if f != filename:
+                                    os.unlink(f)
+                        elif original_filename is not None and original_filename != filename:
+                            os.unlink(original_filename)
+            if filename not in (original_filename, destination_filename) and os.path.exists(filename):
+                # Not moved, the destination already exists
+                os.unlink(filename)
+            if moved and state is not None:
+                state.record(original_filename, plan, destination_filename)
 
             return destination_filename, out_ext
 
-    def _rename(self, cmd, destination_filename, metadata):
-        from_re = cmd.get('from', '.*')
-        to_re = cmd.get('to')
-        format_ = cmd.get('format')
-        if format_ in ['upper', 'lower']:
-            def format_term(term):
-                if format_ == 'upper':
-                    return term.upper()
-                else:
-                    return term.lower()
-            return re.sub(
-                from_re,
-                lambda m: format_term(m.group(0)),
-                destination_filename
-            )
-        else:
-            return self._format(
-                destination_filename, from_re, to_re,
-                cmd.get('metadata', False), metadata,
-                cmd.get('template')
-            )
+    @staticmethod
+    def _remove_temp_files(original_filename, *filenames):
+        for filename in filenames:
+            if filename is not None and filename != original_filename and os.path.exists(filename):
+                os.unlink(filename)
 
     @staticmethod
-    def _format(destination_filename, from_re, to_re, do_metadata=False, metadata=None, template=None):
-        if do_metadata is True:
-            if template == 'jinja':
-                template = jinja2.Template(to_re)
-                to_re = template.render(
-                    len=len, str=str,
-                    format_num_on_demon=format_num_on_demon,
-                    m=metadata, **metadata
-                )
-            else:
-                to_re = to_re.format(**metadata)
+    def _temp_filename(directory, extension):
+        filename = temp_filename(directory, extension)
+        journal = get_journal()
+        if journal is not None:
+            journal.temp(filename)
+        return filename
 
-        return re.sub(from_re, to_re, destination_filename)
+    @staticmethod
+    def _journal_move(filenames, destination):
+        journal = get_journal()
+        if journal is not None and filenames is not None:
+            journal.move(filenames, destination)
 
-    def destination_filename(self, names, filename, extension=None, metadata=None):
-        cmds_config = metatask.config.get("cmds", {})
-        cmds = []
-        for cmd in names:
-            if isinstance(cmd, str):
-                c = cmds_config.get(cmd)
-                if c is None:
-                    raise Exception(f"Missing command '{cmd!s}' in `cmds`")
-                cmds.append(c)
-            else:
-                cmds.append(cmd)
+    @staticmethod
+    def _move(source, destination, linked, placeholder=True):
+        """
+        Move the source on the claimed destination, the placeholder is removed on error.
+        """
+        try:
+            move_file(source, destination, linked)
+        except BaseException:
+            # The source is still there
+            if placeholder and not linked and os.path.exists(destination):
+                os.unlink(destination)
+            raise
 
-        types = set()
-        messages = []
+    def _rename(self, cmd, destination_filename, metadata):
+        return RenameStep(cmd).apply(destination_filename, metadata)
 
-        for cmd in cmds:
-            types.add(cmd.get('type', 'cmd'))
+    @staticmethod
+    def _format(destination_filename, from_re, to_re, do_metadata=False, metadata=None, template=None):
+        return format_filename(destination_filename, from_re, to_re, do_metadata, metadata, template)
 
-            if cmd.get('type') == 'rename':
-                if "do" in cmd:
-                    for do in cmd["do"]:
-                        filename = self._rename(do, filename, metadata)
-                else:
-                    filename = self._rename(cmd, filename, metadata)
-            if cmd.get("type" == "metadata"):
-                value = cmd.get('value_format')
-                value = self._format(
-                    filename,
-                    "^.*{}.*$".format(cmd.get("value_get")),
-                    cmd.get("value_format"),
-                )
-                messages.append("Set the metadata '{!s}' to '{!s}'.".format(
-                    bashcolor.colorize(cmd.get('name'), bashcolor.BLUE),
-                    bashcolor.colorize(value, bashcolor.GREEN)
-                ))
-            else:
-                if 'out_ext' in cmd:
-                    extension = cmd['out_ext']
-
-        if extension is not None:
-            filename = "{!s}.{!s}".format(re.sub(
-                r"\.[a-z0-9A-Z]{2,5}$", "",
-                filename
-            ), extension)
-        return filename, extension, types, messages
+    def destination_filename(self, names, filename, extension=None, metadata=None):
+        return CommandPlan.get(names).destination_filename(filename, extension, metadata)
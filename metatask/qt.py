@@ -0,0 +1,16 @@
+from PyQt5.QtCore import QObject, pyqtSignal
+
+
+class QtProgress(QObject):
+    """
+    A progress callback for `Process` that emits a Qt signal, e.g.:
+
+        progress = QtProgress()
+        progress.progress.connect(slot)
+        process = Process(progress)
+    """
+
+    progress = pyqtSignal(int, str, str, dict)
+
+    def __call__(self, no, name, cmd, config):
+        self.progress.emit(no, name, cmd, config)
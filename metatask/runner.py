@@ -0,0 +1,198 @@
+import os
+import atexit
+import signal
+import asyncio
+import threading
+import subprocess
+import concurrent.futures
+import metatask
+
+
+DEFAULT_RESOURCES = {"cpu": 1}
+
+
+class ResourceBudget:
+    """
+    Budgets per resource class (e.g. `cpu`, `io`), a command is admitted only when all
+    the resources it declares are available.
+
+    A weight greater than the budget is reduced to the budget, and the resources without
+    budget are not limited.
+    """
+
+    def __init__(self, budgets):
+        self.budgets = dict(budgets)
+        self.available = dict(budgets)
+        self._condition = None
+
+    def _weights(self, resources):
+        return {
+            name: min(weight, self.budgets[name])
+            for name, weight in resources.items() if name in self.budgets
+        }
+
+    async def acquire(self, resources):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        weights = self._weights(resources)
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: all(self.available[name] >= weight for name, weight in weights.items())
+            )
+            for name, weight in weights.items():
+                self.available[name] -= weight
+
+    async def release(self, resources):
+        async with self._condition:
+            for name, weight in self._weights(resources).items():
+                self.available[name] += weight
+            self._condition.notify_all()
+
+
+class CommandRunner:
+    """
+    Run the shell commands with asyncio, in an event loop running in a background thread.
+
+    At most `nb_commands` commands run at the same time, whatever the number of threads
+    that wait on them, and the commands are admitted against the `resources` budgets.
+    The commands can have a timeout, and `cancel` kills the running commands and cancels
+    the waiting ones.
+    """
+
+    def __init__(self, nb_commands=None, resources=None):
+        if nb_commands is None:
+            nb_commands = metatask.config.get("nb_commands", metatask.config.get("nb_process", 8))
+        if resources is None:
+            resources = metatask.config.get("resources", {})
+        self.nb_commands = nb_commands
+        self.budget = ResourceBudget(resources)
+        self.cancelled = False
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = None
+        self._tasks = set()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="metatask-runner", daemon=True)
+        self._thread.start()
+
+    async def run_async(self, cmd, timeout=None, resources=None, shell=None):
+        """
+        Run a shell command, raise a `subprocess.CalledProcessError` if it fails
+        and a `subprocess.TimeoutExpired` if it's too long.
+
+        `resources` is a dictionary resource class => weight, default is one `cpu`.
+        `shell` is the shell and its options, e.g. `["bash", "-o", "pipefail"]`, default is `/bin/sh`.
+        """
+        if resources is None:
+            resources = DEFAULT_RESOURCES
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.nb_commands)
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await self.budget.acquire(resources)
+            try:
+                await self._run(cmd, timeout, shell)
+            finally:
+                await self.budget.release(resources)
+        finally:
+            self._tasks.discard(task)
+
+    async def _run(self, cmd, timeout, shell):
+        async with self._semaphore:
+            if self.cancelled:
+                raise asyncio.CancelledError()
+            # In a new session to be able to kill the whole command
+            if shell is None:
+                process = await asyncio.create_subprocess_shell(cmd, start_new_session=True)
+            else:
+                process = await asyncio.create_subprocess_exec(*shell, "-c", cmd, start_new_session=True)
+            try:
+                returncode = await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                await self._kill(process)
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            except asyncio.CancelledError:
+                await self._kill(process)
+                raise
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, cmd)
+
+    @staticmethod
+    async def _kill(process):
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+    def run(self, cmd, timeout=None, resources=None, shell=None):
+        """
+        Run a shell command from any thread and wait for it,
+        raise a `concurrent.futures.CancelledError` if the runner is cancelled.
+        """
+        if self.cancelled:
+            raise concurrent.futures.CancelledError()
+        return asyncio.run_coroutine_threadsafe(
+            self.run_async(cmd, timeout, resources, shell), self._loop
+        ).result()
+
+    def submit(self, coroutine):
+        """
+        Run a coroutine in the event loop, returns a `concurrent.futures.Future`.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def cancel(self):
+        """
+        Kill the running commands and cancel the waiting ones.
+        """
+        self.cancelled = True
+
+        def cancel_tasks():
+            for task in list(self._tasks):
+                task.cancel()
+        self._loop.call_soon_threadsafe(cancel_tasks)
+
+    def close(self):
+        if self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self._loop.close()
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_runner():
+    """
+    Get the shared command runner, started on the first call.
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = CommandRunner()
+            atexit.register(close_runner)
+        return _runner
+
+
+def close_runner():
+    """
+    Stop the shared command runner if it's started.
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is not None:
+            _runner.close()
+            _runner = None
+
+
+def reset_runner():
+    """
+    Forget the command runner of the parent, its thread doesn't exist in a forked worker process.
+    """
+    global _runner, _runner_lock
+    _runner = None
+    _runner_lock = threading.Lock()
@@ -0,0 +1,238 @@
+import os
+import time
+import atexit
+import hashlib
+import sqlite3
+import threading
+import metatask
+from metatask.cache import CACHE_PATH, COMMIT_INTERVAL, COMMIT_DELAY
+
+
+STATE_PATH = os.path.join(os.path.dirname(CACHE_PATH), "state.sqlite")
+HASHES = ["full", "sample", "stat"]
+# Size of the read blocks, and of the blocks read in a sampled file
+BLOCK_SIZE = 1 << 20
+# Number of blocks read in a sampled file
+SAMPLE_BLOCKS = 16
+# The paths are stored as bytes since the version 2
+SCHEMA_VERSION = 2
+
+
+def file_hash(filename, mode="sample", sample_size=64 << 20):
+    """
+    Hash the content of the file by blocks, the files bigger than `sample_size` are only sampled
+    in `sample` mode: some blocks evenly spread in the file, and the size.
+    """
+    hash_ = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if mode == "sample" and size > sample_size:
+            hash_.update(str(size).encode())
+            for no in range(SAMPLE_BLOCKS):
+                f.seek(max(size - BLOCK_SIZE, 0) * no // (SAMPLE_BLOCKS - 1))
+                hash_.update(f.read(BLOCK_SIZE))
+        else:
+            while True:
+                block = f.read(BLOCK_SIZE)
+                if not block:
+                    break
+                hash_.update(block)
+    return hash_.hexdigest()
+
+
+class StateStore:
+    """
+    Persistent state of the processed files, for the incremental mode.
+
+    For each source it stores the content hash of the source after the processing, the digest of the
+    command plan and the produced output. A job is up to date if the source, the plan and the output
+    didn't change, the source is hashed only if its size or its modification time changed.
+
+    With `force`, all the jobs are out of date, but the state is still recorded.
+    """
+
+    def __init__(self, path=None, hash_mode=None, sample_size=None, force=False):
+        if path is None:
+            path = metatask.config.get("state_path", STATE_PATH)
+        if hash_mode is None:
+            hash_mode = metatask.config.get("incremental_hash", "sample")
+        if hash_mode not in HASHES:
+            raise Exception(f"Unknown incremental hash '{hash_mode}', should be one of: {', '.join(HASHES)}")
+        if sample_size is None:
+            sample_size = metatask.config.get("incremental_sample_size", 64 << 20)
+        self.hash_mode = hash_mode
+        self.sample_size = sample_size
+        self.force = force
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._statements = []
+        self._pending = {}
+        # The hashes computed in this run, by (path, size, mtime_ns)
+        self._hashes = {}
+        self._last_commit = time.monotonic()
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self._connection.execute("DROP TABLE IF EXISTS state")
+            self._connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "source TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT, plan TEXT, "
+            "output TEXT, output_size INTEGER, output_mtime_ns INTEGER, updated INTEGER)"
+        )
+        self._connection.commit()
+
+    def _hash(self, path, size, mtime_ns):
+        if self.hash_mode == "stat":
+            return None
+        key = (path, size, mtime_ns)
+        hash_ = self._hashes.get(key)
+        if hash_ is None:
+            hash_ = file_hash(path, self.hash_mode, self.sample_size)
+            self._hashes[key] = hash_
+        return hash_
+
+    def _row(self, path):
+        with self._lock:
+            row = self._pending.get(path)
+            if row is None:
+                row = self._connection.execute(
+                    "SELECT * FROM state WHERE source = ?", (path,)
+                ).fetchone()
+        return row
+
+    def is_output(self, source, destination):
+        """
+        Check if the destination is the recorded output of the source, it can be replaced.
+        """
+        row = self._row(os.fsencode(os.path.realpath(source)))
+        return row is not None and row[5] == os.fsencode(os.path.realpath(destination))
+
+    def forget(self, source):
+        """
+        Forget the state of the source, it will be processed again.
+        """
+        path = os.fsencode(os.path.realpath(source))
+        with self._lock:
+            self._pending.pop(path, None)
+            self._write("DELETE FROM state WHERE source = ?", (path,))
+
+    def up_to_date(self, source, plan):
+        """
+        Check if the source was already processed by the plan, and if the output didn't change.
+        """
+        if self.force:
+            return False
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return False
+        path = os.fsencode(os.path.realpath(source))
+        row = self._row(path)
+        if row is None or row[4] != plan.digest:
+            return False
+        _, size, mtime_ns, hash_, _, output, output_size, output_mtime_ns, _ = row
+        # A transformation in place is checked as the source
+        if output != path:
+            try:
+                output_stat = os.stat(output)
+            except OSError:
+                return False
+            if (output_stat.st_size, output_stat.st_mtime_ns) != (output_size, output_mtime_ns):
+                return False
+        if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+            return True
+        # Touched but maybe not modified
+        return hash_ is not None and stat.st_size == size and \
+            self._hash(path, stat.st_size, stat.st_mtime_ns) == hash_
+
+    def record(self, source, plan, output):
+        """
+        Record that the source was processed by the plan to the output, should be called after the processing.
+        """
+        path = os.fsencode(os.path.realpath(source))
+        try:
+            stat = os.stat(path)
+            output_stat = os.stat(output)
+        except OSError:
+            # The source is moved
+            with self._lock:
+                self._pending.pop(path, None)
+                self._write("DELETE FROM state WHERE source = ?", (path,))
+            return
+        row = (
+            path, stat.st_size, stat.st_mtime_ns, self._hash(path, stat.st_size, stat.st_mtime_ns),
+            plan.digest, os.fsencode(os.path.realpath(output)), output_stat.st_size, output_stat.st_mtime_ns,
+            time.time_ns(),
+        )
+        with self._lock:
+            self._pending[path] = row
+            self._write("INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+
+    def _write(self, sql, params):
+        self._statements.append((sql, params))
+        if len(self._statements) >= COMMIT_INTERVAL or time.monotonic() - self._last_commit > COMMIT_DELAY:
+            self.commit()
+
+    def commit(self):
+        with self._connection:
+            for sql, params in self._statements:
+                self._connection.execute(sql, params)
+        self._statements = []
+        self._pending = {}
+        self._last_commit = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self._connection.close()
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_state():
+    """
+    Get the shared state store, None if the incremental mode is disabled.
+    """
+    global _state
+    if metatask.config.get("incremental", False) is not True:
+        return None
+    with _state_lock:
+        if _state is None:
+            _state = StateStore(force=metatask.config.get("force", False) is True)
+            atexit.register(close_state)
+        return _state
+
+
+def close_state():
+    """
+    Commit and close the shared state store if it's open.
+    """
+    global _state
+    with _state_lock:
+        if _state is not None:
+            _state.close()
+            _state = None
+
+
+def reset_state():
+    """
+    Forget the state store of the parent without closing it, in a forked worker process.
+    """
+    global _state, _state_lock
+    _state = None
+    _state_lock = threading.Lock()
+
+
+def commit_state():
+    """
+    Commit the pending writes of the shared state store, e.g. before starting other processes.
+    """
+    with _state_lock:
+        if _state is not None:
+            with _state._lock:
+                _state.commit()
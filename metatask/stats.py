@@ -0,0 +1,144 @@
+import os
+import time
+import array
+import threading
+import contextlib
+import metatask
+from bashcolor import colorize, BLUE
+
+
+PERCENTILES = [50, 95, 99]
+
+
+class Stats:
+    """
+    The durations of the instrumented operations, by name, they can be merged from the worker processes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations = {}
+
+    def record(self, name, duration):
+        with self._lock:
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = self._durations[name] = array.array('d')
+            durations.append(duration)
+
+    def drain(self):
+        """
+        Get and reset the durations, to be sent by a worker process.
+        """
+        with self._lock:
+            durations = self._durations
+            self._durations = {}
+        return {name: list(values) for name, values in durations.items()}
+
+    def merge(self, durations):
+        with self._lock:
+            for name, values in durations.items():
+                self._durations.setdefault(name, array.array('d')).extend(values)
+
+    def summary(self):
+        """
+        Get a dictionary name => count, total, mean and percentiles, in seconds.
+        """
+        with self._lock:
+            durations = {name: sorted(values) for name, values in self._durations.items()}
+        summary = {}
+        for name, values in sorted(durations.items()):
+            total = sum(values)
+            summary[name] = {"count": len(values), "total": total, "mean": total / len(values)}
+            for percentile in PERCENTILES:
+                index = min(len(values) - 1, len(values) * percentile // 100)
+                summary[name][f"p{percentile}"] = values[index]
+        return summary
+
+    def table(self):
+        columns = ["count", "total", "mean"] + [f"p{percentile}" for percentile in PERCENTILES]
+        summary = self.summary()
+        width = max([len(name) for name in summary] + [9])
+        lines = [" ".join([f"{'operation':<{width}}"] + [f"{column:>10}" for column in columns])]
+        for name, values in summary.items():
+            lines.append(" ".join(
+                [colorize(f"{name:<{width}}", BLUE), f"{values['count']:>10}"]
+                + [f"{values[column] * 1000:>8.2f}ms" for column in columns[1:]]
+            ))
+        return "\n".join(lines)
+
+
+def rss():
+    """
+    Get the resident memory of the process in bytes, the peak one where /proc isn't available.
+    """
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        # In kilobytes
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+_stats = None
+_stats_lock = threading.Lock()
+
+
+def get_stats():
+    """
+    Get the shared statistics, None if they are not enabled in the configuration.
+    """
+    global _stats
+    if metatask.config.get("stats", False) is not True:
+        return None
+    if _stats is None:
+        with _stats_lock:
+            if _stats is None:
+                _stats = Stats()
+    return _stats
+
+
+def reset_stats():
+    """
+    Forget the statistics, e.g. the ones of the parent in a forked worker process.
+    """
+    global _stats
+    with _stats_lock:
+        _stats = None
+
+
+@contextlib.contextmanager
+def measure(name):
+    """
+    Record the duration of the block, if the statistics are enabled.
+    """
+    stats = get_stats()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.record(name, time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def locked(lock, name="lock"):
+    """
+    Acquire the lock, and record the wait and the hold durations if the statistics are enabled.
+    """
+    stats = get_stats()
+    if stats is None:
+        with lock:
+            yield
+        return
+    start = time.perf_counter()
+    with lock:
+        acquired = time.perf_counter()
+        stats.record(f"{name}.wait", acquired - start)
+        try:
+            yield
+        finally:
+            stats.record(f"{name}.hold", time.perf_counter() - acquired)
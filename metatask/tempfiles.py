@@ -0,0 +1,108 @@
+import os
+import errno
+import shutil
+import tempfile
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+# The temporary files are created next to the destination, with this prefix
+TEMP_PREFIX = ".metatask-"
+# The Linux ioctl to clone a file (reflink)
+FICLONE = 0x40049409
+
+
+def temp_filename(directory=None, extension=None):
+    """
+    Get a new temporary filename in the directory (or in the system temporary directory),
+    the file doesn't exist.
+    """
+    suffix = '' if extension is None else '.' + extension
+    try:
+        fd, name = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix=suffix, dir=directory or None)
+    except OSError:
+        fd, name = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix=suffix)
+    os.close(fd)
+    # Some commands refuse to overwrite an existing file
+    os.unlink(name)
+    return name
+
+
+def clone_file(source, destination):
+    """
+    Copy the file content, with a reflink or `copy_file_range` when the filesystem supports it.
+    """
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+                return
+            except OSError:
+                pass
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(source_file.fileno(), destination_file.fileno(), 1 << 30) != 0:
+                    pass
+                return
+            except OSError:
+                source_file.seek(0)
+                destination_file.seek(0)
+                destination_file.truncate()
+        shutil.copyfileobj(source_file, destination_file, 1 << 20)
+
+
+def link_or_clone(source, destination):
+    """
+    Hard link the file, or clone it on failure.
+
+    The destination should only be replaced (e.g. by exiftool), never modified in place.
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        clone_file(source, destination)
+
+
+def claim_destination(source, destination):
+    """
+    Atomically create the destination, raise `FileExistsError` if it already exists.
+
+    The destination is a hard link of the source when possible, and True is returned,
+    otherwise it's an empty placeholder, and False is returned, that should be replaced by `move_file`.
+    """
+    try:
+        os.link(source, destination, follow_symlinks=False)
+        return True
+    except FileExistsError:
+        raise
+    except (OSError, NotImplementedError):
+        pass
+    os.close(os.open(destination, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+    return False
+
+
+def move_file(source, destination, linked=False):
+    """
+    Move the source on the destination, the copy between two filesystems is done in a temporary
+    file next to the destination, then the destination is replaced atomically.
+
+    With `linked` the destination is already a hard link of the source.
+    """
+    if not linked:
+        try:
+            os.replace(source, destination)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        temp_name = temp_filename(os.path.dirname(destination))
+        try:
+            shutil.copy2(source, temp_name)
+            os.replace(temp_name, destination)
+        except BaseException:
+            if os.path.exists(temp_name):
+                os.unlink(temp_name)
+            raise
+    os.unlink(source)
@@ -1,9 +1,19 @@
 import os
 import re
-import json
+import zlib
+import threading
 import datetime
-import subprocess
+import itertools
+import collections
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 from bashcolor import colorize, RED, GREEN, INVERSE
+from metatask.exiftool import get_exiftool, ExifToolError
+from metatask.cache import get_cache
+from metatask.tempfiles import TEMP_PREFIX
+from metatask.stats import measure
 
 
 def common_start(str1, str2):
@@ -61,42 +71,147 @@ def split(path):
     path, folder = os.path.split(path)
     result.append(folder)
     while path != '':
-        path, folder = os.path.split(path)
+        parent, folder = os.path.split(path)
+        if parent == path:
+            # Root of an absolute path
+            break
+        path = parent
         result.append(folder)
     return result
 
 
+def compile_filenames(filenames):
+    """
+    Compile the filename regexps in one alternation, `match` like `re.match` on any of them.
+    """
+    try:
+        return re.compile("|".join(f"(?:{filename})" for filename in filenames)).match
+    except re.error:
+        # e.g. a pattern with global flags
+        patterns = [re.compile(filename) for filename in filenames]
+        return lambda name: any(pattern.match(name) for pattern in patterns)
+
+
 def files(directories, ignore_dir, filenames=None):
+    """
+    Walk the directories and yield the (path, name) of the files that match one of the `filenames`
+    regexps, the directories where a folder name matches one of the `ignore_dir` regexps are pruned.
+    Our temporary files are skipped.
+    """
     if filenames is None:
         filenames = ['.*']
-    ignore_dir = set(ignore_dir)
-    ignore_dir = [re.compile(i) for i in ignore_dir]
+    ignore = [re.compile(i) for i in set(ignore_dir)]
+    match = compile_filenames(filenames)
+
+    def ignored(name):
+        for i in ignore:
+            if i.match(name) is not None:
+                return True
+        return False
+
     for directory in directories:
         if os.path.isdir(directory):
-            # for f in glob.iglob(args.directory, recursive=True):
-            stop = False
-            for path, _, files in os.walk(directory):
-                for p in set(split(path)):
-                    for i in ignore_dir:
-                        stop = i.match(p) is not None
-                        if stop:
-                            break
-                    if stop:
-                        break
-                if stop:
+            if any(ignored(p) for p in set(split(directory))):
+                continue
+            stack = [directory]
+            while stack:
+                path = stack.pop()
+                try:
+                    with measure("walk"), os.scandir(path) as iterator:
+                        entries = list(iterator)
+                except OSError:
                     continue
-                for f_ in files:
-                    for filename in filenames:
-                        if re.match(filename, f_):
-                            full_path = re.sub(
-                                r"^\./", "", os.path.join(path, f_)
-                            )
-                            yield full_path, f_
-                            break
+                sub_directories = []
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not entry.is_symlink() and not ignored(entry.name):
+                            sub_directories.append(entry.path)
+                    elif match(entry.name) and not entry.name.startswith(TEMP_PREFIX):
+                        full_path = entry.path
+                        if full_path.startswith("./"):
+                            full_path = full_path[2:]
+                        yield full_path, entry.name
+                # Same order as os.walk
+                stack.extend(reversed(sub_directories))
         elif os.path.isfile(directory):
             yield directory, os.path.split(directory)[-1]
 
 
+def chunks(iterable, size):
+    """
+    Split an iterable in lists of `size` elements.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ordered_map(executor, function, iterable, window):
+    """
+    Like `executor.map` but with at most `window` pending jobs,
+    the results are yielded in the input order.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class FileLock:
+    """
+    A lock shared between the threads and the processes, with `lockf` on the byte `offset`
+    of a lock file.
+
+    The file is opened on the first use, so the lock should be created before a fork
+    but not used.
+    """
+
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.offset = offset
+        self._lock = threading.Lock()
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        fcntl.lockf(self._file, fcntl.LOCK_EX, 1, self.offset)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.lockf(self._file, fcntl.LOCK_UN, 1, self.offset)
+        self._lock.release()
+
+
+class StripedLock:
+    """
+    A set of locks, a path is always guarded by the same one, so the operations
+    on different paths can run in parallel.
+
+    With a `path` the locks are shared between the processes, see `FileLock`.
+    """
+
+    def __init__(self, stripes=64, path=None):
+        self._locks = [
+            threading.Lock() if path is None else FileLock(path, offset) for offset in range(stripes)
+        ]
+
+    def get(self, path):
+        # Not `hash`, that depends on the process
+        return self._locks[zlib.crc32(path.encode('utf-8', errors='surrogateescape')) % len(self._locks)]
+
+
 def confirm(prompt=None, resp=False):
     """
     Prompts for yes or no response from the user. Returns True for yes and
@@ -137,27 +252,101 @@ def confirm(prompt=None, resp=False):
             return False
 
 
-def read_metadata(filename, read_types=True):
-    metadata = json.loads(str(subprocess.check_output([
-        "/usr/bin/exiftool", "-json", filename
-    ]), encoding='utf-8', errors='strict'))[0]
-    if read_types is True:
-        for k in metadata.keys():
-            if isinstance(metadata[k], str):
+class LazyMetadata(dict):
+    """
+    The metadata of a file where only some tags are read,
+    the missing tags are read with exiftool on the first access,
+    except the `absent` ones that were already read without value.
+    """
+
+    def __init__(self, filename, metadata, read_types=True, absent=()):
+        super().__init__(metadata)
+        self.filename = filename
+        self.read_types = read_types
+        self.absent = set(absent)
+
+    def __missing__(self, tag):
+        if tag not in self.absent:
+            metadata = _read_raw([self.filename], [tag]).get(self.filename, {})
+            if tag in metadata:
+                if self.read_types is True:
+                    parse_types(metadata)
+                self[tag] = metadata[tag]
+                return metadata[tag]
+            self.absent.add(tag)
+        raise KeyError(tag)
+
+
+def read_metadata(filename, read_types=True, exiftool=None, tags=None):
+    metadata = read_metadata_batch([filename], read_types, exiftool, tags).get(filename)
+    if metadata is None:
+        raise ExifToolError(f"Error on getting metadata on '{filename!s}'.")
+    return metadata
+
+
+def read_metadata_batch(filenames, read_types=True, exiftool=None, tags=None):
+    """
+    Read the metadata of many files, from the cache or with the same exiftool process,
+    returns a dictionary filename => metadata, the unreadable files are missing.
+
+    If `tags` is not None only those tags are read and the metadata are `LazyMetadata`.
+    """
+    if tags is not None and len(tags) == 0:
+        # Just check that the file is readable
+        tags = ["FileName"]
+    with measure("read_metadata"):
+        results = _read_raw(filenames, tags, exiftool)
+        for filename, metadata in results.items():
+            if read_types is True:
+                parse_types(metadata)
+            if tags is not None:
+                results[filename] = LazyMetadata(
+                    filename, metadata, read_types, absent=[tag for tag in tags if tag not in metadata]
+                )
+    return results
+
+
+def _read_raw(filenames, tags=None, exiftool=None):
+    cache = get_cache()
+    results = {}
+    missing = []
+    for filename in filenames:
+        metadata = cache.get(filename, tags) if cache is not None else None
+        if metadata is None:
+            missing.append(filename)
+        else:
+            results[filename] = metadata
+    if missing:
+        if exiftool is None:
+            exiftool = get_exiftool()
+        with measure("exiftool.read"):
+            read = exiftool.read(missing, tags)
+        if cache is not None:
+            for filename, metadata in read.items():
+                cache.put(filename, metadata, tags)
+        results.update(read)
+    return results
+
+
+DATE_RE = re.compile(r"^([0-9]{4}:[0-9]{2}:[0-9]{2}|[0-9]{2}/[0-9]{2}/[0-9]{4}) [0-9]")
+
+
+def parse_types(metadata):
+    for k in metadata.keys():
+        if isinstance(metadata[k], str) and DATE_RE.match(metadata[k]) is not None:
+            try:
+                metadata[k] = datetime.datetime.strptime(
+                    metadata[k], "%Y:%m:%d %H:%M:%S"
+                )
+            except ValueError:
                 try:
                     metadata[k] = datetime.datetime.strptime(
-                        metadata[k], "%Y:%m:%d %H:%M:%S"
+                        metadata[k], "%Y:%m:%d %H:%M:%S%z"
                     )
                 except ValueError:
                     try:
                         metadata[k] = datetime.datetime.strptime(
-                            metadata[k], "%Y:%m:%d %H:%M:%S%z"
+                            metadata[k], "%d/%m/%Y %H:%M:%S"
                         )
                     except ValueError:
-                        try:
-                            metadata[k] = datetime.datetime.strptime(
-                                metadata[k], "%d/%m/%Y %H:%M:%S"
-                            )
-                        except ValueError:
-                            pass
-    return metadata
+                        pass
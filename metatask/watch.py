@@ -0,0 +1,249 @@
+import os
+import re
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import metatask
+from bashcolor import colorize, RED
+from metatask.tempfiles import TEMP_PREFIX
+from metatask.utils import compile_filenames
+
+
+# Seconds without modification before a file is processed
+DEBOUNCE = 0.5
+# Seconds between two checks of the directories, without inotify
+POLL_INTERVAL = 1
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+# struct inotify_event: wd, mask, cookie, len, then the name
+EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+    The inotify events of the watched directories, with ctypes.
+
+    `read` returns the (path, is directory) of the created, written or moved in entries,
+    and (None, False) when events were lost.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self._directories = {}
+
+    def add(self, directory):
+        wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), directory)
+        self._directories[wd] = directory
+
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 1 << 16)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, False))
+            elif mask & IN_IGNORED:
+                self._directories.pop(wd, None)
+            elif name and wd in self._directories:
+                events.append((os.path.join(self._directories[wd], os.fsdecode(name)), bool(mask & IN_ISDIR)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """
+    Fallback of `Inotify`, the directories are listed at each check, and the entries that are new
+    or with a new modification time or size are reported, e.g. a file rewritten in place.
+    """
+
+    def __init__(self, interval=None):
+        if interval is None:
+            interval = metatask.config.get("watch_poll_interval", POLL_INTERVAL)
+        self.interval = interval
+        self._directories = {}
+
+    @staticmethod
+    def _list(directory):
+        """
+        Get the entries of the directory, name => (is directory, modification time, size).
+        """
+        entries = {}
+        with os.scandir(directory) as iterator:
+            for entry in iterator:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                    is_directory = entry.is_dir(follow_symlinks=False)
+                    entries[entry.name] = (is_directory, stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    pass
+        return entries
+
+    def add(self, directory):
+        try:
+            self._directories[directory] = self._list(directory)
+        except OSError:
+            pass
+
+    def read(self, timeout):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        events = []
+        for directory, entries in list(self._directories.items()):
+            try:
+                new_entries = self._list(directory)
+            except OSError:
+                del self._directories[directory]
+                continue
+            self._directories[directory] = new_entries
+            for name, entry in new_entries.items():
+                if entries.get(name) != entry and not (entry[0] and name in entries):
+                    events.append((os.path.join(directory, name), entry[0]))
+        return events
+
+    def close(self):
+        pass
+
+
+class Watcher:
+    """
+    Watch the directories recursively, and get the new or written files that match the
+    `filenames` regexps once they were not modified for `debounce` seconds.
+
+    With inotify, or by polling the directories where it's not available. The files produced
+    by metatask are ignored, see `produced`.
+    """
+
+    def __init__(self, directories, ignore_dir, filenames=None, debounce=None):
+        if debounce is None:
+            debounce = metatask.config.get("watch_debounce", DEBOUNCE)
+        self.directories = directories
+        self.debounce = debounce
+        self.ignore = [re.compile(i) for i in set(ignore_dir)]
+        self.match = compile_filenames(filenames or ['.*'])
+        self._watched = set()
+        self._pending = {}
+        self._produced = {}
+        try:
+            self._backend = Inotify()
+        except (OSError, AttributeError):
+            self._backend = Poller()
+        for directory in directories:
+            if os.path.isdir(directory):
+                self._add_tree(directory)
+
+    def _ignored(self, name):
+        return any(i.match(name) is not None for i in self.ignore)
+
+    def _add(self, directory):
+        try:
+            self._backend.add(directory)
+        except OSError as e:
+            if not isinstance(self._backend, Inotify) or e.errno not in (errno.ENOSPC, errno.EMFILE):
+                return
+            sys.stderr.write(colorize(f"Unable to watch with inotify ({e.strerror}), polling\n", RED))
+            self._backend.close()
+            self._backend = Poller()
+            for watched in self._watched:
+                self._backend.add(watched)
+            self._backend.add(directory)
+        self._watched.add(directory)
+
+    def _add_tree(self, root, scan=False):
+        """
+        Watch the directory and its sub directories, with `scan` their files are pending,
+        e.g. for a directory moved in the tree, or created just before its files.
+        """
+        for directory, sub_directories, names in os.walk(root):
+            sub_directories[:] = [d for d in sub_directories if not self._ignored(d)]
+            self._add(directory)
+            if scan:
+                for name in names:
+                    self._file(os.path.join(directory, name))
+
+    def _file(self, path):
+        name = os.path.basename(path)
+        if self.match(name) and not name.startswith(TEMP_PREFIX):
+            if path.startswith("./"):
+                path = path[2:]
+            self._pending[path] = time.monotonic() + self.debounce
+
+    def produced(self, filenames):
+        """
+        Ignore the next events of the files produced by metatask, while they are not modified.
+        """
+        for filename in filenames:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            self._produced[filename] = (stat.st_size, stat.st_mtime_ns)
+
+    def _ready(self):
+        now = time.monotonic()
+        ready = []
+        for path, deadline in list(self._pending.items()):
+            if deadline > now:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            age = time.time() - stat.st_mtime
+            if age < self.debounce:
+                # Still written
+                self._pending[path] = now + self.debounce - age
+                continue
+            del self._pending[path]
+            if self._produced.pop(path, None) != (stat.st_size, stat.st_mtime_ns):
+                ready.append(path)
+        return sorted(ready)
+
+    def wait(self):
+        """
+        Wait for events, and returns the files that are ready to be processed, possibly none.
+        """
+        timeout = None
+        if self._pending:
+            timeout = max(0, min(self._pending.values()) - time.monotonic())
+        for path, is_directory in self._backend.read(timeout):
+            if path is None:
+                # Lost events
+                for directory in self.directories:
+                    if os.path.isdir(directory):
+                        self._add_tree(directory, scan=True)
+            elif is_directory:
+                if not self._ignored(os.path.basename(path)):
+                    self._add_tree(path, scan=True)
+            else:
+                self._file(path)
+        return self._ready()
+
+    def close(self):
+        self._backend.close()
@@ -26,6 +26,7 @@ setup(
     classifiers=[
         "Programming Language :: Python :: 3",
     ],
+    python_requires=">=3.9",
     author="Stéphane Brunner",
     author_email="stephane.brunner@gmail.com",
     url="https://github.com/sbrunner/metatask/",
@@ -33,11 +34,15 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=install_requires,
+    extras_require={
+        "qt": ["PyQt5"],
+    },
     setup_requires=setup_requires,
     tests_require=tests_require,
     entry_points={
         "console_scripts": [
             "metatask = metatask:main",
+            "metatask-benchmark = metatask.benchmark:main",
         ],
     }
 )